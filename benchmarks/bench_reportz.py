@@ -0,0 +1,253 @@
+"""reportz自身开销的基准测试
+
+生成1k/10k/100k个简单用例的合成suite(可调整每个用例的输出大小, 失败比例和类数量), 分别测量:
+
+- 与unittest.TextTestRunner(buffer=True)相比每个用例的额外开销(Runner, HTMLRunner, 线程池)
+- Result.register的耗时, sortByClass的耗时
+- templates目录下每个完整报告模板generate_report的渲染耗时和HTML大小(paged模板经PagedReportWriter生成)
+- 每个场景的峰值RSS(每个场景在单独的spawn子进程中执行)
+
+结果写入JSON文件, 可用--compare与之前的结果对比:
+
+    python benchmarks/bench_reportz.py --sizes 1000 10000 -o bench.json
+    python benchmarks/bench_reportz.py --sizes 1000 10000 -o bench_new.json --compare bench.json
+"""
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import jinja2
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import reportz  # noqa: E402
+
+MODES = ('runner', 'html', 'threads')
+
+
+def make_suite(size, classes, output_size, failure_rate):
+    """生成size个用例, 平均分布在classes个类中, 每failure_every个用例失败一个"""
+    failure_every = int(1 / failure_rate) if failure_rate else 0
+    text = 'x' * output_size
+    per_class = -(-size // classes)
+    suite = unittest.TestSuite()
+    index = 0
+    for class_index in range(classes):
+        methods = {}
+        for _ in range(min(per_class, size - index)):
+            fail = failure_every and index % failure_every == failure_every - 1
+            methods['test_%06d' % index] = make_test(text, fail)
+            index += 1
+        if not methods:
+            break
+        test_class = type('BenchTest%04d' % class_index, (unittest.TestCase,), methods)
+        test_class.__module__ = 'bench_suite'
+        suite.addTests(test_class(name) for name in sorted(methods))
+    return suite
+
+
+def make_test(text, fail):
+    def test(self):
+        if text:
+            print(text)
+        if fail:
+            self.fail('synthetic failure')
+    return test
+
+
+def peak_rss():
+    """当前进程的峰值RSS(字节)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+
+def bench_baseline(scenario):
+    suite = make_suite(**scenario)
+    runner = unittest.TextTestRunner(stream=io.StringIO(), buffer=True)
+    seconds, _ = timed(runner.run, suite)
+    return {'seconds': seconds}
+
+
+def bench_runner(scenario, thread_num=None):
+    suite = make_suite(**scenario)
+    result = reportz.Result()
+    result.echo = False
+    seconds, _ = timed(reportz.Runner().run, suite, result=result, thread_num=thread_num)
+    sort_seconds, _ = timed(result.sortByClass)
+    return {'seconds': seconds, 'sort_by_class_seconds': sort_seconds}
+
+
+def bench_register(scenario):
+    """只测量Result.register(经addSuccess/addFailure)的耗时"""
+    suite = make_suite(**scenario)
+    result = reportz.Result()
+    result.echo = False
+    total = 0.0
+    for test in suite:
+        result.startTest(test)
+        start = time.perf_counter()
+        result.addSuccess(test)
+        total += time.perf_counter() - start
+        result.stopTest(test)
+    return {'seconds': total, 'per_test_us': total / scenario['size'] * 1e6}
+
+
+STREAM_TEMPLATES = ('stream', 'live')  # 执行过程中按块/定时写入, 不能一次渲染整个报告
+
+def bench_html(scenario, directory):
+    suite = make_suite(**scenario)
+    output = os.path.join(directory, 'report.html')
+    runner = reportz.HTMLRunner(output=output, echo=False)
+    seconds, result = timed(runner.run, suite)
+    templates = {}
+    for name in sorted(os.listdir(reportz.TEMPLATE_DIR)):
+        if not name.endswith('.html') or name.startswith('_'):  # _开头的是被其他模板include的片段
+            continue
+        template = name[:-5]
+        if template in STREAM_TEMPLATES:
+            continue
+        output = os.path.join(directory, 'report_%s.html' % template)
+        options = {'paged': True} if template == 'paged' else {'template': template}
+        try:
+            render_seconds, _ = timed(reportz.HTMLRunner(output=output, **options).generate_report, result)
+        except jinja2.TemplateError as e:  # 无法编译的模板只记录错误
+            templates[template] = {'error': str(e)}
+            continue
+        templates[template] = {'seconds': render_seconds, 'html_bytes': os.path.getsize(output)}
+    return {'seconds': seconds, 'templates': templates}
+
+
+def run_scenario(scenario, mode):
+    """在子进程中执行单个场景, 返回测量结果"""
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)  # 日志/缓存等文件写到临时目录
+        stdout, sys.stdout = sys.stdout, io.StringIO()  # 合成用例失败时unittest会打印到stderr/stdout
+        try:
+            if mode == 'baseline':
+                data = bench_baseline(scenario)
+            elif mode == 'register':
+                data = bench_register(scenario)
+            elif mode == 'runner':
+                data = bench_runner(scenario)
+            elif mode == 'threads':
+                data = bench_runner(scenario, thread_num=4)
+            else:
+                data = bench_html(scenario, directory)
+        finally:
+            sys.stdout = stdout
+    data['peak_rss'] = peak_rss()
+    return data
+
+
+def run_isolated(scenario, mode):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_scenario, (scenario, mode))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, classes, output_sizes, failure_rates, modes):
+    results = []
+    for size, class_num, output_size, failure_rate in itertools.product(sizes, classes, output_sizes, failure_rates):
+        scenario = dict(size=size, classes=class_num or max(size // 100, 1), output_size=output_size,
+                        failure_rate=failure_rate)
+        item = dict(scenario, baseline=run_isolated(scenario, 'baseline'), register=run_isolated(scenario, 'register'))
+        for mode in modes:
+            data = run_isolated(scenario, mode)
+            data['overhead_per_test_us'] = (data['seconds'] - item['baseline']['seconds']) / size * 1e6
+            item[mode] = data
+        results.append(item)
+        print(summary(item), file=sys.stderr)
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+
+def scenario_key(item):
+    return item['size'], item['classes'], item['output_size'], item['failure_rate']
+
+
+def summary(item):
+    parts = ['size=%(size)s classes=%(classes)s output=%(output_size)s failure=%(failure_rate)s' % item,
+             'baseline=%.3fs' % item['baseline']['seconds'],
+             'register=%.1fus' % item['register']['per_test_us']]
+    parts.extend('%s=%.3fs(+%.1fus/test)' % (mode, item[mode]['seconds'], item[mode]['overhead_per_test_us'])
+                 for mode in MODES if mode in item)
+    return ' '.join(parts)
+
+
+def compare(new, old):
+    """按场景打印新旧结果的耗时比例, 大于1表示变慢"""
+    old_results = {scenario_key(item): item for item in old['results']}
+    for item in new['results']:
+        previous = old_results.get(scenario_key(item))
+        if previous is None:
+            continue
+        ratios = ['register=%.2f' % (item['register']['seconds'] / previous['register']['seconds'])]
+        for mode in MODES:
+            if mode in item and mode in previous:
+                ratios.append('%s=%.2f' % (mode, item[mode]['seconds'] / previous[mode]['seconds']))
+        for name, data in item.get('html', {}).get('templates', {}).items():
+            before = previous.get('html', {}).get('templates', {}).get(name)
+            if before and 'seconds' in before and 'seconds' in data:
+                ratios.append('%s=%.2f' % (name, data['seconds'] / before['seconds']))
+        print('size=%s classes=%s output=%s failure=%s: %s' % (scenario_key(item) + (' '.join(ratios),)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--classes', type=int, nargs='+', default=[0], help='number of classes, 0 for size/100')
+    parser.add_argument('--output-sizes', type=int, nargs='+', default=[100], help='characters printed per test')
+    parser.add_argument('--failure-rates', type=float, nargs='+', default=[0.05])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('-o', '--output', default='bench_reportz.json')
+    parser.add_argument('--compare', help='previous json result to compare with')
+    args = parser.parse_args(argv)
+
+    data = run_benchmarks(args.sizes, args.classes, args.output_sizes, args.failure_rates, args.modes)
+    with open(args.output, 'w') as f:
+        json.dump(data, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(data, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,131 @@
 import time
 import platform
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import unittest
-from jinja2 import Template
-from collections import defaultdict
-from itertools import groupby
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from collections import defaultdict, deque
 import sys
 import io
 from unittest.suite import _isnotsuite
 import pickle
 import time
-import signal
 import inspect
 import importlib
-from concurrent.futures import ThreadPoolExecutor
+import functools
+import linecache
+import multiprocessing
+from multiprocessing.connection import wait
+import threading
+import contextvars
+import ctypes
+import heapq
+import json
+import re
+import operator
+import fnmatch
+import traceback
+import tempfile
+import base64
+import gzip
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from reportz.attachments import AttachmentStore, AttachMixin, attach, current_test
+from reportz.clusters import FailureClusters
+from reportz.exporters import JsonLinesExporter, JUnitExporter, read_jsonl
+from reportz.history import CACHE_DIR, DurationHistory, LastFailed, RunHistory
+from reportz.impact import CoverageMap
+from reportz.live import EventBus, LiveReport, LiveServer
+from reportz.profiling import Instrumentation, run_fixture
 
 class TimeoutError(Exception):
-    def __init__(self, msg):
+    def __init__(self, msg=''):
         super(TimeoutError, self).__init__()
         self.msg = msg
 
-def set_timeout(interval, callback):
-    def decorator(func):
-        def handler(signum, frame):
-            raise TimeoutError("run func timeout")
-        def wrapper(*args, **kwargs):
-            try:
-                signal.signal(signal.SIGALRM, handler)
-                signal.alarm(interval)       # interval秒后向进程发送SIGALRM信号
-                result = func(*args, **kwargs)
-                signal.alarm(0)              # 函数在规定时间执行完后关闭alarm闹钟
-                return result
-            except TimeoutError as e:
-                callback(func, e)
-        return wrapper
+def timeout(seconds):
+    """设置用例方法或测试类的超时时间(秒), 支持小数, 优先于Runner的默认超时"""
+    def decorator(obj):
+        obj.timeout = seconds
+        return obj
     return decorator
 
+
+def test_timeout(test, default=None):
+    """用例的超时时间: 方法上的timeout > 类的timeout属性 > 默认值"""
+    for obj in (getattr(test, test._testMethodName, None), test.__class__):
+        value = getattr(obj, 'timeout', None)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+    return default
+
+
+def tag(*names):
+    """给用例方法或测试类打标签, 方法上的标签和类上的标签合并"""
+    def decorator(obj):
+        obj.tags = tuple(getattr(obj, 'tags', ())) + names
+        return obj
+    return decorator
+
+
+def level(value):
+    """设置用例方法或测试类的级别, 默认为2"""
+    def decorator(obj):
+        obj.level = value
+        return obj
+    return decorator
+
+
+def test_tags(test):
+    """用例方法上的标签 + 类/实例上的标签(可在setUp中设置self.tags)"""
+    tags = list(getattr(getattr(test, test._testMethodName, None), 'tags', ()))
+    tags.extend(name for name in getattr(test, 'tags', ()) if name not in tags)
+    return tags
+
+
+def test_level(test):
+    """用例的级别: 方法上的level > 类/实例的level > 2"""
+    return getattr(getattr(test, test._testMethodName, None), 'level', getattr(test, 'level', 2))
+
+
+def async_raise(thread, exc_type):
+    """尽力向仍在执行的线程抛出异常, 阻塞在C代码中的线程要等返回后才会收到"""
+    try:
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), ctypes.py_object(exc_type))
+    except AttributeError:  # 非CPython
+        pass
+
+def is_async_test(test):
+    """IsolatedAsyncioTestCase或协程方法的用例"""
+    return (isinstance(test, unittest.IsolatedAsyncioTestCase)
+            or inspect.iscoroutinefunction(getattr(test, test._testMethodName, None)))
+
+
+async def call_maybe_async(function, *args, **kwargs):
+    value = function(*args, **kwargs)
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+def noop():
+    pass
+
 def run_suite_after(suite, result):
-    suite._tearDownPreviousClass(None, result)
-    suite._handleModuleTearDown(result)
+    previous = getattr(result, '_previousTestClass', None)
+    run_fixture(result, 'tearDownClass', previous, suite._tearDownPreviousClass, None, result)
+    run_fixture(result, 'tearDownModule', previous and previous.__module__, suite._handleModuleTearDown, result)
 
 def run_suite_before_case(suite, case, result):
-    suite._tearDownPreviousClass(case, result)
-    suite._handleModuleFixture(case, result)
-    suite._handleClassSetUp(case, result)
+    previous = getattr(result, '_previousTestClass', None)
+    if previous is case.__class__:
+        suite._tearDownPreviousClass(case, result)
+        suite._handleModuleFixture(case, result)
+        suite._handleClassSetUp(case, result)
+    else:  # 切换了类, 统计fixture耗时, setUpModule中包含上一个模块的tearDownModule
+        run_fixture(result, 'tearDownClass', previous, suite._tearDownPreviousClass, case, result)
+        run_fixture(result, 'setUpModule', case.__class__.__module__, suite._handleModuleFixture, case, result)
+        run_fixture(result, 'setUpClass', case.__class__, suite._handleClassSetUp, case, result)
     result._previousTestClass = case.__class__
     if (getattr(case.__class__, '_classSetupFailed', False) or getattr(result, '_moduleSetUpFailed', False)):
         return False
@@ -71,43 +152,561 @@ def group_suites_by_class(suite):
     suite_list = list(suite_dict.values())
     return suite_list
 
-class Loader(unittest.TestLoader):
 
-    # def discover(self, testspath='.', pattern="*.py"):
-    #     return unittest.defaultTestLoader.discover(testspath, pattern)
+def partition_suites(suite_list, num, weight=None):
+    """把按类分组的suite分配到num个分片, 同一模块的类在分片内保持相邻"""
+    weight = weight or (lambda suite: suite.countTestCases())
+    shards = [[] for _ in range(num)]
+    loads = [0] * num
+    order = {id(suite): index for index, suite in enumerate(suite_list)}
+    for suite in sorted(suite_list, key=weight, reverse=True):  # 最长的先分配
+        index = loads.index(min(loads))
+        shards[index].append(suite)
+        loads[index] += weight(suite)
+    for shard in shards:
+        modules = {}
+        for suite in sorted(shard, key=lambda x: order[id(x)]):
+            modules.setdefault(suite_module(suite), []).append(suite)
+        shard[:] = [suite for suites in modules.values() for suite in suites]
+    return shards
 
-    
-    def load_tests_by_config(self, testlist_file):  # test_list_file配置在config/config.py中
-        with open(testlist_file) as f:
-            testlist = f.readlines()
 
-        testlist = [i.strip() for i in testlist if not i.startswith("#")]   # 去掉每行结尾的"/n"和 #号开头的行
+def order_failed_first(suite, failed):
+    """上次失败的用例先执行: 含失败用例的模块和类排在前面, 类内失败的用例在前, 同一模块/类的用例保持相邻"""
+    modules = {}
+    for class_suite in group_suites_by_class(suite):
+        modules.setdefault(suite_module(class_suite), []).append(
+            unittest.TestSuite(sorted(class_suite, key=lambda test: test.id() not in failed)))
 
-        suite = unittest.TestSuite() 
-        all_cases = collect()  # 所有用例
-        for case in all_cases:  # 从所有用例中匹配用例方法名
-            if case._testMethodName in testlist:
-                suite.addTest(case)
-        return suite
+    def passed(class_suite):
+        return next(iter(class_suite)).id() not in failed
+    ordered = sorted(modules.values(), key=lambda class_suites: all(passed(x) for x in class_suites))
+    return unittest.TestSuite(class_suite for class_suites in ordered for class_suite in sorted(class_suites, key=passed))
 
-    def load_tests_by_tag(self, expr):
+
+def duration_weight(durations=None):
+    """按历史耗时(秒)计算一组用例的权重, 没有历史记录的用例按平均耗时计算"""
+    durations = durations or {}
+    default = sum(durations.values()) / len(durations) if durations else 1
+
+    def weight(class_suite):
+        return sum(durations.get(test.id(), default) for test in class_suite)
+    return weight
+
+
+def shard_suite(suite, index, total, durations=None):
+    """按类把用例确定性地分成total片, 返回第index片(从1开始), durations为用例id到历史耗时(秒)的映射"""
+    shards = partition_suites(group_suites_by_class(suite), total, weight=duration_weight(durations))
+    return unittest.TestSuite(test for class_suite in shards[index - 1] for test in class_suite)
+
+
+def suite_module(suite):
+    for test in suite:
+        return test.__class__.__module__
+
+
+def suite_spec(suite):
+    """按类分组的suite转为可pickle的(模块, 类, 方法名列表)"""
+    tests = list(suite)
+    test_class = tests[0].__class__
+    return test_class.__module__, test_class.__qualname__, [test._testMethodName for test in tests]
+
+
+def load_suite_spec(spec):
+    module_name, class_name, method_names = spec
+    test_class = importlib.import_module(module_name)
+    for name in class_name.split('.'):
+        test_class = getattr(test_class, name)
+    return unittest.TestSuite(test_class(name) for name in method_names)
+
+
+def run_specs_in_process(specs, conn, timeout=None, options=None):
+    """子进程入口: 按顺序执行分配的类, 每个用例开始和登记时通过管道回传, 超时由父进程监控"""
+    result = WorkerResult(conn, timeout)
+    vars(result).update(options or {})
+    result._testRunEntered = True
+    runner = Runner()
+    for spec in specs:
+        suite = load_suite_spec(spec)
+        result.index_tests(suite)
+        runner.run_suite(suite, result, run_func=runner.run_test)
+    run_suite_after(unittest.TestSuite(), result)
+    result.ship()
+    conn.send(('done', result.instrument.worker_state() if result.instrument is not None else None))
+    conn.close()
+
+
+STATUS_KEYS = {
+    'PASS': 'pass_num',
+    'FAIL': 'fail_num',
+    'ERROR': 'error_num',
+    'SKIPPED': 'skipped_num',
+    'XFAIL': 'xfail_num',
+    'XPASS': 'xpass_num',
+    'TIMEOUT': 'timeout_num',
+}
+FAILED_KEYS = ('fail_num', 'error_num', 'timeout_num')
+
+
+def new_stats(**kwargs):
+    return dict(total=0, pass_num=0, fail_num=0, error_num=0, skipped_num=0,
+                xfail_num=0, xpass_num=0, timeout_num=0, rerun_num=0, duration=timedelta(), **kwargs)
+
+
+def add_stats(stats, record):
+    stats['total'] += 1
+    stats[STATUS_KEYS.get(record.status, 'error_num')] += 1  # setUpClass_ERROR等也计入出错
+    stats['rerun_num'] += len(record.attempts)
+    if record.duration:
+        stats['duration'] += record.duration
+
+
+def record_class_name(test_class):
+    """TestRecord.test_class: '模块.类名', __main__中的类只有类名"""
+    if test_class.__module__ == '__main__':
+        return test_class.__name__
+    return '%s.%s' % (test_class.__module__, test_class.__name__)
+
+
+def merge_result(result, child):
+    if isinstance(result, Result):
+        result.merge_records(*child.pop_records())
+        return
+    result.testsRun += child.testsRun
+    for name in ('failures', 'errors', 'skipped', 'expectedFailures', 'unexpectedSuccesses'):
+        getattr(result, name).extend(getattr(child, name))
+
+
+class TestRecord(object):
+    """单个用例的执行结果, 不持有TestCase对象, 模块/类/状态等重复字符串使用intern"""
+    __slots__ = ('sn', 'name', 'full_name', 'full_path', 'doc', '_code', 'source', 'status',
+                 'setup_status', 'teardown_status', 'test_class', 'test_class_doc', 'test_module',
+                 'start_at', 'end_at', 'duration', 'exec_info', 'output', 'log', 'metrics', 'tags', 'level',
+                 'attempts', 'files', 'attachments', 'failure', 'exception')
+
+    def __init__(self, name, full_name, full_path, status, test_class, test_module, sn=None,
+                 doc=None, code=None, source=None, setup_status=None, teardown_status=None, test_class_doc=None,
+                 start_at=None, end_at=None, duration=0, exec_info='', output='', log=None, metrics=None, tags=(),
+                 level=2, attempts=(), files=(), attachments=(), failure=None, exception=None):
+        self.sn = sn
+        self.name = name
+        self.full_name = full_name
+        self.full_path = full_path
+        self.doc = doc
+        self._code = code
+        self.source = source  # (文件, qualname, 行号), 用到code时才读取源码
+        self.status = sys.intern(status)
+        self.setup_status = setup_status
+        self.teardown_status = teardown_status
+        self.test_class = sys.intern(test_class)
+        self.test_class_doc = test_class_doc
+        self.test_module = sys.intern(test_module)
+        self.start_at = start_at
+        self.end_at = end_at
+        self.duration = duration
+        self.exec_info = exec_info
+        self.output = output
+        self.log = log  # 输出超出内存上限时完整输出所在的文件
+        self.metrics = metrics  # 开启性能分析时的cpu/memory_peak/memory_net/pstats
+        self.tags = tags
+        self.level = level
+        self.attempts = attempts  # 失败重试前各次执行的结果(status, exec_info, output, duration)
+        self.files = files  # 开启CoverageMap时用例调用过的源文件
+        self.attachments = attachments  # 附件信息, 见AttachmentStore.add
+        self.failure = failure  # 失败的指纹, 见FailureClusters
+        self.exception = exception  # 失败时traceback中最终的异常行
+
+    def __repr__(self):
+        return '<TestRecord %s %s>' % (self.full_path, self.status)
+
+    @property
+    def code(self):
+        if self._code is None:
+            return get_source(*self.source) if self.source else ''
+        return self._code
+
+    def append(self, output='', exec_info='', log=None):
+        """同一用例再次登记(如tearDownClass出错)时追加输出和异常信息"""
+        self.log = self.log or log
+        if output:
+            self.output = '\n'.join([self.output, output]) if self.output else output
+        if exec_info:
+            self.exec_info = '\n'.join([self.exec_info, exec_info]) if self.exec_info else exec_info
+
+    def to_dict(self):
+        """转为可JSON序列化的dict, 时间使用ISO格式, 耗时单位为秒"""
+        data = {name: getattr(self, name) for name in self.__slots__ if name != '_code'}
+        data['start_at'] = self.start_at.isoformat() if self.start_at else None
+        data['end_at'] = self.end_at.isoformat() if self.end_at else None
+        data['duration'] = self.duration.total_seconds() if self.duration else 0
+        data['tags'] = list(self.tags)
+        data['attempts'] = list(self.attempts)
+        data['files'] = list(self.files)
+        data['attachments'] = list(self.attachments)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = {name: value for name, value in data.items() if name in cls.__slots__}
+        data['start_at'] = datetime.fromisoformat(data['start_at']) if data.get('start_at') else None
+        data['end_at'] = datetime.fromisoformat(data['end_at']) if data.get('end_at') else None
+        data['duration'] = timedelta(seconds=data['duration']) if data.get('duration') else 0
+        data['source'] = tuple(data['source']) if data.get('source') else None
+        return cls(**data)
+
+
+def source_ref(function):
+    function = inspect.unwrap(function)
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return None
+    return code.co_filename, function.__qualname__, code.co_firstlineno
+
+
+def get_source(filename, qualname, lineno):
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return ''
+    return _get_source(filename, mtime, qualname, lineno)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_source(filename, mtime, qualname, lineno):
+    """按(文件, 修改时间, qualname)缓存, 文件修改后自动失效"""
+    linecache.checkcache(filename)
+    lines = linecache.getlines(filename)
+    if len(lines) < lineno:
+        return ''
+    return ''.join(inspect.getblock(lines[lineno - 1:]))
+
+
+def worker_crash_record(module_name, class_name, name, exitcode, status='ERROR', exec_info=None, output='', log=None):
+    return TestRecord(name=name, full_name='%s (%s.%s)' % (name, module_name, class_name),
+                      full_path='%s.%s.%s' % (module_name, class_name, name), status=status,
+                      test_class='%s.%s' % (module_name, class_name), test_module=module_name,
+                      exec_info=exec_info or 'worker process exited with code %s' % exitcode, output=output, log=log)
+
+
+class TestIndex(object):
+    """discover结果的索引: 用例id -> 模块/类/方法/tags/level/doc, 以及按tag/level/方法名的倒排索引
+    按模块文件缓存到磁盘, 文件mtime未变的模块不再导入, 只在生成suite时导入选中用例所在的模块"""
+    VERSION = 1
+    LEVEL_OPS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq,
+                 '!=': operator.ne}
+
+    def __init__(self, start_dir='.', pattern='test*.py', top_level_dir=None,
+                 cache=os.path.join(CACHE_DIR, 'index.json')):
+        self.start_dir = os.path.abspath(start_dir)
+        self.pattern = pattern
+        self.top_level_dir = os.path.abspath(top_level_dir or start_dir)
+        self.cache = cache
+        self.tests = {}  # 用例id -> entry, 按discover的顺序
+        self.errors = {}  # 导入失败的模块名 -> 异常信息, 不缓存
+        self.imported = 0  # 本次构建导入的模块数
+        self.by_tag = defaultdict(set)
+        self.by_level = defaultdict(set)
+        self.by_name = defaultdict(set)
+        self.position = {}
+        self.build()
+
+    def module_files(self, directory=None):
+        """与unittest的discover顺序一致: 匹配pattern的文件, 子目录需为包"""
+        directory = directory or self.start_dir
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                if os.path.isfile(os.path.join(path, '__init__.py')):
+                    yield from self.module_files(path)
+            elif name.endswith('.py') and name[:-3].isidentifier() and fnmatch.fnmatch(name, self.pattern):
+                yield path, os.path.relpath(path, self.top_level_dir)[:-3].replace(os.sep, '.')
+
+    def load_cache(self):
+        try:
+            with open(self.cache) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        key = '%s|%s' % (self.top_level_dir, self.pattern)
+        return data.get(key, {}) if data.get('version') == self.VERSION else {}
+
+    def save_cache(self, modules):
+        data = {}
+        try:
+            with open(self.cache) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if data.get('version') != self.VERSION:
+            data = {'version': self.VERSION}
+        data['%s|%s' % (self.top_level_dir, self.pattern)] = modules
+        directory = os.path.dirname(self.cache)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.cache + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(self.cache + '.tmp', self.cache)
+
+    def scan_module(self, module_name):
+        """导入模块并提取其中的用例"""
+        module = importlib.import_module(module_name)
+        entries = []
+        for test in flatten_suite(unittest.defaultTestLoader.loadTestsFromModule(module)):
+            if not isinstance(test, unittest.TestCase) or isinstance(test, unittest.loader._FailedTest):
+                continue
+            test_class = test.__class__
+            entries.append(dict(id=test.id(), module=test_class.__module__, test_class=test_class.__qualname__,
+                                name=test._testMethodName, tags=test_tags(test), level=test_level(test),
+                                doc=test._testMethodDoc))
+        return entries
+
+    def build(self):
+        if self.top_level_dir not in sys.path:
+            sys.path.insert(0, self.top_level_dir)
+        cached = self.load_cache()
+        modules, changed = {}, False
+        for path, module_name in self.module_files():
+            mtime = os.path.getmtime(path)
+            item = cached.get(path)
+            if item is None or item['mtime'] != mtime or item['module'] != module_name:
+                try:
+                    item = dict(mtime=mtime, module=module_name, tests=self.scan_module(module_name))
+                except Exception:
+                    self.errors[module_name] = traceback.format_exc()
+                    continue
+                self.imported += 1
+                changed = True
+            modules[path] = item
+            for entry in item['tests']:
+                self.add(entry)
+        if changed or set(modules) != set(cached):
+            self.save_cache(modules)
+
+    def add(self, entry):
+        test_id = entry['id']
+        self.position[test_id] = len(self.tests)
+        self.tests[test_id] = entry
+        for name in entry['tags']:
+            self.by_tag[name].add(test_id)
+        self.by_level[entry['level']].add(test_id)
+        self.by_name[entry['name']].add(test_id)
+
+    def match_tags(self, expr):
+        """标签表达式, 支持and/or/not和括号, 如 'smoke and not slow'"""
+        tokens = re.findall(r'\(|\)|[^\s()]+', expr)
+        universe = set(self.tests)
+
+        def parse_or():
+            ids = parse_and()
+            while tokens and tokens[0] == 'or':
+                tokens.pop(0)
+                ids = ids | parse_and()
+            return ids
+
+        def parse_and():
+            ids = parse_not()
+            while tokens and tokens[0] == 'and':
+                tokens.pop(0)
+                ids = ids & parse_not()
+            return ids
+
+        def parse_not():
+            token = tokens.pop(0) if tokens else None
+            if token == 'not':
+                return universe - parse_not()
+            if token == '(':
+                ids = parse_or()
+                if not tokens or tokens.pop(0) != ')':
+                    raise ValueError('unbalanced parentheses in tag expression: %s' % expr)
+                return ids
+            if token in (None, ')', 'and', 'or'):
+                raise ValueError('invalid tag expression: %s' % expr)
+            return self.by_tag.get(token, set())
+
+        ids = parse_or()
+        if tokens:
+            raise ValueError('invalid tag expression: %s' % expr)
+        return ids
+
+    def match_level(self, expr):
+        """级别表达式, 如 1 / 1,2 / <=2"""
+        expr = str(expr).replace(' ', '')
+        match = re.match(r'(<=|>=|<|>|==|!=)(-?\d+)$', expr)
+        if match:
+            op, value = self.LEVEL_OPS[match.group(1)], int(match.group(2))
+            levels = [level for level in self.by_level if op(level, value)]
+        else:
+            levels = [int(value) for value in expr.split(',')]
+        return set().union(*(self.by_level.get(level, ()) for level in levels))
+
+    def select(self, tags=None, level=None, names=None):
+        """按标签表达式/级别表达式/方法名或用例id筛选, 返回按discover顺序排列的用例id"""
+        ids = None
+        if tags:
+            ids = self.match_tags(tags)
+        if level is not None:
+            ids = self.match_level(level) if ids is None else ids & self.match_level(level)
+        if names is not None:
+            matched = set().union(*(self.by_name.get(name, {name} & self.tests.keys()) for name in names))
+            ids = matched if ids is None else ids & matched
+        if ids is None:
+            return list(self.tests)
+        return sorted(ids, key=self.position.get)
+
+    def suite(self, ids=None):
+        """生成选中用例的suite, 只导入选中用例所在的模块; 不传ids时包含全部用例和导入失败的模块"""
         suite = unittest.TestSuite()
-        for case in collect():
-            if case._testMethodDoc and tag in case._testMethodDoc:  # 如果用例方法存在docstring,并且docstring中包含本标签
-                suite.addTest(case)
+        if ids is None:
+            ids = list(self.tests)
+            for module_name in self.errors:
+                suite.addTest(unittest.loader._make_failed_import_test(module_name, unittest.TestSuite)[1])
+        specs = {}
+        for test_id in ids:
+            entry = self.tests[test_id]
+            specs.setdefault((entry['module'], entry['test_class']), []).append(entry['name'])
+        for (module_name, class_name), names in specs.items():
+            suite.addTest(load_suite_spec((module_name, class_name, names)))
         return suite
 
-    
+
+class Loader(unittest.TestLoader):
+    """基于TestIndex按配置/标签/级别加载用例"""
+    def __init__(self, start_dir='.', pattern='test*.py', top_level_dir=None):
+        super().__init__()
+        self.start_dir = start_dir
+        self.pattern = pattern
+        self.top_level_dir = top_level_dir
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = TestIndex(self.start_dir, self.pattern, self.top_level_dir)
+        return self._index
+
+    def load_tests_by_config(self, testlist_file):  # 每行一个用例方法名或用例id, #开头的行忽略
+        with open(testlist_file) as f:
+            testlist = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        return self.index.suite(self.index.select(names=testlist))
+
+    def load_tests_by_tag(self, expr):
+        return self.index.suite(self.index.select(tags=expr))
+
     def load_tests_by_level(self, expr):
-        pass
+        return self.index.suite(self.index.select(level=expr))
 
-    def load_last_fails(self):
-        pass
+    def load_last_fails(self, suite, path=None):
+        """从suite中选出上次执行失败的用例"""
+        last_failed = LastFailed(path) if path else LastFailed()
+        failed = set(last_failed.ids)
+        return unittest.TestSuite(test for test in flatten_suite(suite) if test.id() in failed)
     
+class CaptureBuffer(object):
+    """用例输出缓冲: 内存中最多保留limit个字符, 超出后完整输出写入log_dir下的临时文件, 内存中只保留开头和结尾;
+    eager为True时从一开始就按行写入文件, 进程被杀掉后其他进程仍能读取已有的输出(见read_capture)"""
+    def __init__(self, limit=1 << 20, log_dir=None, name='output', eager=False):
+        self.limit = limit
+        self.log_dir = log_dir
+        self.name = name
+        self.eager = eager
+        self.buffer = io.StringIO()
+        self.size = 0
+        self.file = None
+        self.path = None  # 超出limit后完整输出所在的文件
+        self.head = ''
+        self.tail = deque()
+        self.tail_size = 0
+        if eager:
+            self.spill()
+
+    def write(self, s):
+        self.size += len(s)
+        if self.file is None:
+            self.buffer.write(s)
+            if self.limit and self.size > self.limit:
+                self.spill()
+        else:
+            self.file.write(s)
+            if self.limit:  # limit为0时不限制, 输出都在文件中, close时读回内存
+                self.tail.append(s)
+                self.tail_size += len(s)
+                while len(self.tail) > 1 and self.tail_size - len(self.tail[0]) >= self.limit // 2:
+                    self.tail_size -= len(self.tail.popleft())
+        return len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.file is not None and not self.file.closed:
+            self.file.flush()
+
+    def spill(self):
+        text, self.buffer = self.buffer.getvalue(), None
+        log_dir = self.log_dir or os.path.join(tempfile.gettempdir(), 'reportz-logs')
+        os.makedirs(log_dir, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='%s-' % self.name, suffix='.log', dir=log_dir)
+        self.file = open(fd, 'w', buffering=1 if self.eager else -1, encoding='utf-8', errors='replace')
+        self.file.write(text)
+        self.head = text[:self.limit // 2]
+        self.tail.append(text[len(text) - self.limit // 2:])
+        self.tail_size = len(self.tail[0])
+
+    def getvalue(self):
+        if self.file is None:
+            return self.buffer.getvalue()
+        self.flush()
+        if not self.limit:
+            with open(self.path, encoding='utf-8', errors='replace') as f:
+                return f.read()
+        tail = ''.join(self.tail)
+        tail = tail[len(tail) - self.limit // 2:]
+        return '%s\n...... %s characters omitted, full output: %s ......\n%s' % (
+            self.head, self.size - len(self.head) - len(tail), self.path, tail)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            if self.eager and (not self.limit or self.size <= self.limit):  # 未超出limit, 输出放回内存并删除文件
+                with open(self.path, encoding='utf-8', errors='replace') as f:
+                    self.buffer = io.StringIO(f.read())
+                os.remove(self.path)
+                self.file = self.path = None
+
+
+def read_capture(path, limit=1 << 20):
+    """读取被杀掉的进程中eager CaptureBuffer写入的输出, 返回(输出, 完整输出文件), 未超出limit时删除文件"""
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if not limit or size <= limit:
+                text = f.read().decode('utf-8', 'replace')
+            else:
+                head = f.read(limit // 2).decode('utf-8', 'replace')
+                f.seek(size - limit // 2)
+                tail = f.read().decode('utf-8', 'replace')
+                return '%s\n...... %s characters omitted, full output: %s ......\n%s' % (
+                    head, size - len(head) - len(tail), path, tail), path
+    except OSError:
+        return '', None
+    os.remove(path)
+    return text, None
+
+
 class OutputRedirector(object):
-    """ Wrapper to redirect stdout or stderr """
+    """ Wrapper to redirect stdout or stderr, 每个线程(上下文)单独重定向 """
     def __init__(self, fp):
-        self.fp = fp
+        self.default = fp
+        self._fp = contextvars.ContextVar('fp', default=None)
+
+    @property
+    def fp(self):
+        return self._fp.get() or self.default
+
+    @fp.setter
+    def fp(self, fp):
+        self._fp.set(fp)
 
     def write(self, s):
         self.fp.write(s)
@@ -120,94 +719,223 @@ class OutputRedirector(object):
 
 stdout_redirector = OutputRedirector(sys.stdout)
 stderr_redirector = OutputRedirector(sys.stderr)
+redirector_lock = threading.Lock()
+redirector_count = 0
+
+
+def install_redirectors():
+    """第一个开始捕获的线程替换sys.stdout/sys.stderr, 捕获期间被其他代码替换时重新接管"""
+    global redirector_count
+    with redirector_lock:
+        if sys.stdout is not stdout_redirector:
+            stdout_redirector.default = sys.stdout
+            sys.stdout = stdout_redirector
+        if sys.stderr is not stderr_redirector:
+            stderr_redirector.default = sys.stderr
+            sys.stderr = stderr_redirector
+        redirector_count += 1
+
+
+def uninstall_redirectors():
+    """最后一个结束捕获的线程还原sys.stdout/sys.stderr"""
+    global redirector_count
+    with redirector_lock:
+        redirector_count -= 1
+        if redirector_count == 0:
+            if sys.stdout is stdout_redirector:
+                sys.stdout = stdout_redirector.default
+            if sys.stderr is stderr_redirector:
+                sys.stderr = stderr_redirector.default
+
+
+def outcome(method):
+    """Result.addXxx: 与addTimeout互斥, 已按超时登记的用例(被放弃的线程)迟到的结果直接丢弃"""
+    @functools.wraps(method)
+    def wrapper(self, test, *args):
+        with self._lock:
+            if test.id() in self.timed_out:
+                self.complete_capture()
+                return
+            return method(self, test, *args)
+    return wrapper
+
+
+def add_outcome(result, test_id, status, exec_info=''):
+    """按状态把其他进程回传的用例加入result的success/failures/errors等列表, result可以是普通的unittest.TestResult"""
+    if status == 'PASS':
+        if isinstance(result, Result):
+            result.success.append(test_id)
+    elif status == 'FAIL':
+        result.failures.append((test_id, exec_info))
+    elif status == 'SKIPPED':
+        result.skipped.append((test_id, exec_info))
+    elif status == 'XFAIL':
+        result.expectedFailures.append((test_id, exec_info))
+    elif status == 'XPASS':
+        result.unexpectedSuccesses.append(test_id)
+    else:
+        result.errors.append((test_id, exec_info))
+        if status == 'TIMEOUT' and isinstance(result, Result):
+            result.timeouts.append(test_id)
 
 
 class Result(unittest.TestResult):
     def __init__(self, verbosity=1):
         super().__init__(verbosity=verbosity)
         self.verbosity = verbosity
+        # 各结果列表中只保存用例id, 不持有用例实例: failures/errors/skipped/expectedFailures为(用例id, 异常信息)
         self.timeouts = []
         self.success = []
-        self.timeouts = []
         self.result = {}
-        self.test_class = defaultdict(list)
+        self.test_class = {}  # 按登记顺序分组, 同时累计各类的统计数据
+        self.stats = new_stats()
         self.sn = 1
-        self.stdout_bak = None
-        self.stderr_bak = None
+        self._output = contextvars.ContextVar('output', default=None)  # 每个线程/任务单独捕获
+        self.timed_out = set()  # 已按超时登记的用例, 其线程后续的登记被忽略
+        self._lock = threading.RLock()  # addTimeout与用例线程中的addXxx互斥
+        self.output_limit = 1 << 20  # 每个用例在内存中保留的输出字符数, 超出的写入log_dir下的文件
+        self.log_dir = None
+        self.echo = True  # 登记时把用例输出打印到控制台
+        self.instrument = None  # 为Instrumentation时统计每个用例的CPU时间/内存/cProfile
+        self.coverage = None  # 为CoverageMap时记录每个用例调用过的源文件
+        self.events = None  # 为EventBus时发出用例开始/登记等实时事件
+        self.attachments = None  # AttachmentStore, 未设置时附件保存在.reportz/attachments
+        self.reruns = 0  # 失败/出错的用例最多重新执行的次数
+        self.attempts = {}  # 等待重试的用例id到此前各次执行结果的映射
+        self.rerun_pending = set()
+        self._popped_run = 0
+        self.fixture_classes = {}  # '模块.类名' -> (类, {方法名: None}), 见index_tests
+        self.fixture_modules = defaultdict(dict)  # 模块名 -> {'模块.类名': None}
+        self.expected = {}  # 类名(同TestRecord.test_class) -> 将要登记的用例{方法名: 登记后的状态}, 见index_tests
+        self.completed_classes = set()  # 已完成(已通知class_complete)的类
+        self.clusters = FailureClusters()  # 按指纹分组的失败
+        self.listeners = []
+        self.keep_records = True  # 为False时每个类执行完成即释放其结果(流式报告)
     
-    def capture_output(self):
+    OPTIONS = ('reruns', 'output_limit', 'log_dir', 'echo', 'instrument', 'coverage', 'events', 'attachments')
+
+    def options(self):
+        """需要传给线程池/子进程中的Result的配置"""
+        return {name: getattr(self, name) for name in self.OPTIONS}
+
+    def emit(self, event, data):
+        if self.events is not None:
+            self.events.emit(event, data)
+
+    def attach(self, test, name, data, mime=None, move=False):
+        """保存附件并关联到用例, 用例已登记时(如失败后在tearDown中截图)直接加到其记录上"""
+        if self.attachments is None:
+            self.attachments = AttachmentStore(os.path.join(CACHE_DIR, 'attachments'))
+        item = self.attachments.add(name, data, mime, move)
+        record = self.result.get(test.id())
+        if record is not None:
+            record.attachments = list(record.attachments) + [item]
+        else:
+            test.__dict__.setdefault('_attachments', []).append(item)
+        return item
+
+    @property
+    def output(self):
+        return self._output.get()
+
+    def capture_output(self, name='output', eager=False):
         # 重定向sys.out和sys.err
-        self.output = io.StringIO()
-        stdout_redirector.fp = self.output
-        stderr_redirector.fp = self.output
-        self.stdout_bak = sys.stdout
-        self.stderr_bak = sys.stderr
-        sys.stdout = stdout_redirector
-        sys.stderr = stderr_redirector
+        output = CaptureBuffer(self.output_limit, self.log_dir, name, eager)
+        self._output.set(output)
+        stdout_redirector.fp = output
+        stderr_redirector.fp = output
+        install_redirectors()
+
+    def complete_capture(self):
+        """结束当前上下文的捕获, 返回CaptureBuffer, 未捕获(如setUpClass失败未执行的用例)时返回None"""
+        capture = self._output.get()
+        if capture is None:
+            return None
+        self._output.set(None)
+        stdout_redirector.fp = None
+        stderr_redirector.fp = None
+        uninstall_redirectors()
+        capture.close()
+        return capture
 
     def complete_output(self):
-        if self.stdout_bak:
-            sys.stdout = self.stdout_bak
-            sys.stderr = self.stderr_bak
-            self.stdout_bak = None
-            self.stderr_bak = None
-        return self.output.getvalue()
+        capture = self.complete_capture()
+        return capture.getvalue() if capture else ''
+
+    def echo_output(self, capture):
+        """返回(输出, 完整输出文件), 按配置打印到控制台"""
+        output, log = (capture.getvalue(), capture.path) if capture else ('', None)
+        if self.echo:
+            sys.stdout.write(output)
+        return output, log
 
     def startTest(self, test):
-        self.capture_output()
+        self.capture_output(test.id())
+        current_test.set((self, test))
         test.start_at = datetime.now()
+        test.end_at = None
         super().startTest(test)
+        if test.id() in self.attempts:  # 重试不计入执行数, 重试次数见record.attempts
+            self.testsRun -= 1
+        if self.instrument is not None:
+            self.instrument.start_test(test)
+        if self.coverage is not None:
+            self.coverage.start_test(test)
+        self.emit('start_test', {'id': test.id(), 'time': time.time()})
         
     
     def stopTest(self, test):
         test.end_at = datetime.now()
+        current_test.set(None)
         self.complete_output()
+        if self.instrument is not None:
+            self.instrument.stop_test(test)
+        if self.coverage is not None:
+            self.coverage.stop_test(test)
 
 
     def update_test(self, test, status, exec_info='', setup_status=None, teardown_status=None, error_code=None):
-        output = self.complete_output()
-        sys.stdout.write(output)
-        last_output = self.result[test.id()].get(output, '')
-        last_exec_info = self.result[test.id()].get(output, '')
-        self.result[test.id()].update(
-            {
-                'output': '\n'.join([last_output, output]),
-                'exec_info': '\n'.join([last_exec_info, exec_info]),
-            }
-        )
-
-    def register(self, test, status, exec_info='', setup_status=None, teardown_status=None, error_code=None):
-        output = self.complete_output()
-        sys.stdout.write(output)
-
-        test_module_name = test.__module__
-        test_class_name = test.__class__.__name__
+        output, log = self.echo_output(self.complete_capture())
+        record = self.result[test.id()]
+        record.append(output, exec_info, log)
+        if self.late_error(record, status, record.status):
+            record.status = sys.intern(status)
+        self.clusters.update(record)
+        self.notify('update', record)
+        self.emit('update', record)
+
+    def register(self, test, status, exec_info='', setup_status=None, teardown_status=None, error_code=None,
+                 capture=None):
+        if status != 'TIMEOUT' and test.id() in self.timed_out:  # 超时后被放弃的用例迟到的结果
+            self.complete_capture()
+            return
+        output, log = self.echo_output(capture or self.complete_capture())
+
+        test_module_name = '' if test.__module__ == '__main__' else test.__module__
+        test_class_name = record_class_name(test.__class__)
         test_class_doc = test.__class__.__doc__
         test_method_name = test._testMethodName
         test_method_doc = test._testMethodDoc
 
-        if test_module_name == '__main__':
-            test_module_name = ''
-        else:
-            test_class_name = '%s.%s' % (test_module_name, test_class_name)
-
-        test_method = getattr(test.__class__, test_method_name)  # TODO  模块中代码块的失败
+        test_method = getattr(test.__class__, test_method_name, None)  # _FailedTest的方法由__getattr__动态生成
 
-        tags = test.tags if hasattr(test, 'tags') else [],
-        level = test.level if hasattr(test, 'level') else 2
+        tags = test_tags(test)
+        level = test_level(test)
 
         start_at=test.start_at if hasattr(test, 'start_at') else None
-        end_at=test.end_at if hasattr(test, 'end_at') else None
-        duration=(test.end_at - test.start_at) if start_at and end_at else 0
+        end_at=getattr(test, 'end_at', None) or (datetime.now() if start_at else None)  # 登记时stopTest尚未执行
+        duration=(end_at - start_at) if start_at and end_at else 0
+        metrics = self.instrument.stop_test(test) if self.instrument is not None and status != 'TIMEOUT' else None
+        files = self.coverage.stop_test(test) if self.coverage is not None else None
 
         if test.id() not in self.result:
-            item = dict(obj=test, 
+            item = TestRecord(
                 sn = self.sn,
                 name=test_method_name,
                 full_name=str(test),
                 full_path=test.id(),
                 doc=test_method_doc,
-                code=inspect.getsource(test_method),
+                source=source_ref(test_method),
                 status=status,
                 setup_status=setup_status,
                 teardown_status=teardown_status,
@@ -219,147 +947,436 @@ class Result(unittest.TestResult):
                 duration=duration,
                 exec_info=exec_info,
                 output=output,
+                log=log,
+                metrics=metrics,
                 tags = tags,
-                level = level
+                level = level,
+                attempts = self.attempts.pop(test.id(), ()),
+                files = files or (),
+                attachments = test.__dict__.pop('_attachments', ())
                 )
-            self.result[test.id()] = item
-            self.sn += 1
+            if test_class_name in self.completed_classes:  # 类已完成并释放了结果后迟到的fixture错误
+                self.late_update(item)
+                return
+            self.add_item(item)
+            self.emit('register', item)
+            self.check_class(test_class_name)
         else:
             self.update_test(test, status, exec_info=exec_info, 
             setup_status=setup_status, 
             teardown_status=teardown_status, 
             error_code=error_code)
             
-    def sortByClass(self):
-        sorted_result = sorted(list(self.result.values()), key=lambda x: x['test_class'])
-        data = defaultdict(dict)
-        for name, group in groupby(sorted_result, key=lambda x: x['test_class']):
-            test_cases = list(group)
-            data[name] = dict(
-                name=name,
-                test_cases=test_cases,
-                total=len(test_cases),
-                pass_num=len(list(filter(lambda x: x['status']=="PASS", test_cases))),
-                error_num=len(list(filter(lambda x: x['status']=="ERROR", test_cases))),
-                fail_num=len(list(filter(lambda x: x['status']=="FAIL", test_cases))),
-                skipped_num=len(list(filter(lambda x: x['status']=="SKIPPED", test_cases))),
-                xfail_num=len(list(filter(lambda x: x['status']=="XFAIL", test_cases))),
-                xpass_num=len(list(filter(lambda x: x['status']=="XPASS", test_cases)))
-            )
-            test_classes = list(data.values())
-        return test_classes
-
-    def addTimeout(self, err, test):
-        self.timeouts.append(test)
+    def add_listener(self, listener):
+        """监听者可实现register(item), update(item), class_complete(test_class), run_complete(result)"""
+        self.listeners.append(listener)
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            method = getattr(listener, event, None)
+            if method is not None:
+                method(*args)
+
+    def add_item(self, item):
+        name = item.test_class
+        self.result[item.full_path] = item
+        self.clusters.add(item)
+        test_class = self.test_class.get(name)
+        if test_class is None:
+            test_class = self.test_class[name] = new_stats(name=name, test_cases=[])
+        test_class['test_cases'].append(item)
+        add_stats(test_class, item)
+        add_stats(self.stats, item)
+        expected = self.expected.get(name)
+        if expected is not None and item.name in expected:  # 类的结果释放后迟到的fixture错误据此改计统计
+            expected[item.name] = item.status
+        self.sn += 1
+        self.notify('register', item)
+
+    def check_class(self, name):
+        """类的用例都已登记时完成该类, 未经index_tests的类在complete_run时完成"""
+        expected = self.expected.get(name)
+        test_class = self.test_class.get(name)
+        if expected and test_class is not None and test_class['total'] >= len(expected):
+            self.complete_class(name)
+
+    def late_error(self, record, status, old_status):
+        """已登记的用例迟到的fixture错误(如tearDownModule出错): 原先计为通过/跳过等时改计为出错, 返回是否改计"""
+        if status in STATUS_KEYS or old_status is None or STATUS_KEYS.get(old_status, 'error_num') in FAILED_KEYS:
+            return False
+        for stats in (self.stats, self.test_class.get(record.test_class)):
+            if stats is not None:
+                stats[STATUS_KEYS[old_status]] -= 1
+                stats['error_num'] += 1
+        expected = self.expected.get(record.test_class)
+        if expected is not None and record.name in expected:
+            expected[record.name] = status
+        return True
+
+    def late_update(self, item):
+        """已完成并释放了结果的类中迟到的登记: 不再计入类, 按索引中的原状态改计统计, 作为update通知"""
+        self.late_error(item, item.status, self.expected.get(item.test_class, {}).get(item.name))
+        self.clusters.add(item)
+        self.notify('update', item)
+        self.emit('update', item)
+
+    def complete_class(self, name):
+        self.completed_classes.add(name)
+        if self.keep_records:
+            test_class = self.test_class[name]
+        else:
+            test_class = self.test_class.pop(name)
+            for item in test_class['test_cases']:
+                del self.result[item.full_path]
+        self.notify('class_complete', test_class)
+
+    def complete_run(self):
+        for name in [name for name in self.test_class if name not in self.completed_classes]:
+            self.complete_class(name)
+        self.notify('run_complete', self)
+
+    def pop_records(self):
+        """取出已登记的结果以便pickle回传, 返回(记录列表, 执行数)"""
+        records = list(self.result.values())
+        self.result.clear()
+        self.test_class.clear()
+        self.clusters.clear()
+        tests_run, self._popped_run = self.testsRun - self._popped_run, self.testsRun
+        return records, tests_run
+
+    def merge_records(self, records, tests_run=0):
+        """合并其他进程回传的记录, 返回新登记的记录(其余为已有记录的update)"""
+        self.testsRun += tests_run
+        added = []
+        for item in records:
+            if item.full_path in self.result or item.test_class in self.completed_classes:
+                if item.status not in STATUS_KEYS:  # 迟到的fixture错误
+                    self.errors.append((item.full_path, item.exec_info))
+                if item.full_path not in self.result:
+                    self.late_update(item)
+                    continue
+                record = self.result[item.full_path]
+                record.append(item.output, item.exec_info, item.log)
+                if self.late_error(record, item.status, record.status):
+                    record.status = item.status
+                self.clusters.update(record)
+                self.notify('update', record)
+                continue
+            item.sn = self.sn
+            self.add_item(item)
+            added.append(item)
+            add_outcome(self, item.full_path, item.status, item.exec_info)
+            self.check_class(item.test_class)
+        return added
 
+    def sortByClass(self):
+        return list(self.test_class.values())
+
+    def addTimeout(self, test, timeout, capture=None):
+        """用例超时: 登记TIMEOUT及超时前已捕获的输出(capture为用例线程中的CaptureBuffer)"""
+        with self._lock:
+            if test.id() in self.result or test.id() in self.timed_out:  # 恰好在超时前完成
+                return
+            exec_info = 'TimeoutError: test timed out after %ss' % timeout
+            self.timed_out.add(test.id())
+            self.timeouts.append(test.id())
+            self.errors.append((test.id(), exec_info))
+            self.register(test, 'TIMEOUT', exec_info, capture=capture)
+
+
+    def index_tests(self, suite):
+        """记录将要执行的用例所在的模块/类和方法名, 模块或类级fixture出错时据此登记受影响的用例, 无需重新导入和加载"""
+        for test in suite:
+            if isinstance(test, unittest.TestSuite):
+                self.index_tests(test)
+            elif isinstance(test, unittest.TestCase) and not isinstance(test, unittest.loader._FailedTest):
+                test_class = test.__class__
+                name = '%s.%s' % (test_class.__module__, test_class.__qualname__)  # 与_ErrorHolder中的类名一致
+                entry = self.fixture_classes.get(name)
+                if entry is None:
+                    entry = self.fixture_classes[name] = (test_class, {})
+                    self.fixture_modules[test_class.__module__][name] = None
+                entry[1][test._testMethodName] = None
+                self.expected[record_class_name(test_class)] = entry[1]
+
+    def fixture_tests(self, function_name, name):
+        """fixture出错时受影响的用例(新建的用例实例), name为模块名或'模块.类名'"""
+        if function_name in ('setUpModule', 'tearDownModule'):
+            class_names = self.fixture_modules.get(name, ())
+        else:
+            class_names = (name,)
+        for class_name in class_names:
+            test_class, method_names = self.fixture_classes.get(class_name, (None, ()))
+            for method_name in method_names:
+                yield test_class(method_name)
 
     def handle_load_error(self, test, err):
-        err_desc = test.id().replace('(','').replace(')','')
-        function_name, path = err_desc.split()
-
-        path = function_name
-        module = importlib.import_module(path)
-        function = None
-        tests = unittest.defaultTestLoader.loadTestsFromModule(module) 
-            
-        if tests:
-            tests = flatten_suite(tests)
-            for unrun_test in tests:
-                exec_info = self._exc_info_to_string(err, test)
-                self.errors.append((unrun_test, ))
-                self.register(unrun_test, 'LOAD_ERRROR', '')
-        
-
-    def handel_module_setup_teardown_error(self, test, err):
-        err_desc = test.id().replace('(','').replace(')','')
-        function_name, path = err_desc.split()
-
-        module = importlib.import_module(path)
-        function = getattr(module, function_name)
-        tests = unittest.defaultTestLoader.loadTestsFromModule(module)
-        error_code = inspect.getsource(function)  
-            
-        if tests:
-            tests = flatten_suite(tests)
-            for unrun_test in tests:
-                exec_info = self._exc_info_to_string(err, test)
-                self.errors.append((unrun_test, ))
-                self.register(unrun_test, '%s_ERROR' % function_name, '')
-
-    def handle_class_setup_teardown_error(self, test, err):
-        err_desc = test.id().replace('(','').replace(')','')
-        function_name, path = err_desc.split()
-        full_path = path.split('.')
-        module_path = '.'.join(full_path[:-1])
-        class_name = full_path[-1]
-        module = __import__(module_path, globals(), locals(), [class_name])
-        test_class = getattr(module, class_name)
-        function = getattr(test_class, function_name)
-        tests = unittest.defaultTestLoader.loadTestsFromTestCase(test_class)
-
-        if tests:
-            tests = flatten_suite(tests)
-            for unrun_test in tests:
-                exec_info = self._exc_info_to_string(err, test)
-                self.errors.append((unrun_test, ))
-                self.register(unrun_test, '%s_ERROR' % function_name, '')
-
-    
+        """导入失败的模块没有可执行的用例, 登记该_FailedTest本身"""
+        exec_info = self._exc_info_to_string(err, test)
+        self.errors.append((test.id(), exec_info))
+        self.register(test, 'LOAD_ERROR', exec_info)
+
+    def handle_fixture_error(self, test, err, function_name, name):
+        exec_info = self._exc_info_to_string(err, test)
+        found = False
+        for unrun_test in self.fixture_tests(function_name, name):
+            found = True
+            self.errors.append((unrun_test.id(), exec_info))
+            self.register(unrun_test, '%s_ERROR' % function_name, exec_info)
+        if not found:  # 未经index_tests的suite(如直接调用suite(result))
+            self.errors.append((test.id(), exec_info))
+
+    def hold_for_rerun(self, test, status, exec_info):
+        """用例失败且还有重试次数时暂存本次结果而不登记, 由Runner重新执行"""
+        test_id = test.id()
+        attempts = self.attempts.get(test_id, [])
+        if test_id in self.rerun_pending:  # 同一次执行中的多个错误(如doCleanups出错)
+            attempts[-1]['exec_info'] += '\n' + exec_info
+            return True
+        if len(attempts) >= self.reruns or test_id in self.result:
+            return False
+        output, log = self.echo_output(self.complete_capture())
+        start_at = getattr(test, 'start_at', None)
+        attempts.append(dict(status=status, exec_info=exec_info, output=output, log=log,
+                             duration=(datetime.now() - start_at).total_seconds() if start_at else 0,
+                             attachments=test.__dict__.pop('_attachments', [])))
+        self.attempts[test_id] = attempts
+        self.rerun_pending.add(test_id)
+        return True
+
+    @outcome
     def addError(self, test, err):   # 模块或类级Excepition时 result.addError(error, sys.exc_info())
-        if isinstance(test, unittest.TestCase):
-            self.errors.append((test, self._exc_info_to_string(err, test)))
-            self.register(test, 'ERROR', self._exc_info_to_string(err, test))
-
-        elif isinstance(test, unittest.loader._FailedTest):
+        if isinstance(test, unittest.loader._FailedTest):  # _FailedTest也是TestCase, 需先判断
             self.handle_load_error(test, err)
+        elif isinstance(test, unittest.TestCase):
+            exec_info = self._exc_info_to_string(err, test)
+            if self.hold_for_rerun(test, 'ERROR', exec_info):
+                return
+            self.errors.append((test.id(), exec_info))
+            self.register(test, 'ERROR', exec_info)
         else:
             err_desc = test.id().replace('(','').replace(')','')
             function_name, path = err_desc.split()
-            if function_name in ['setUpModule', 'tearDownModule']:
-                self.handel_module_setup_teardown_error(test, err)
-            elif function_name in ['setUpClass', 'tearDownClass']:
-                self.handle_class_setup_teardown_error(test, err)
+            if function_name in ['setUpModule', 'tearDownModule', 'setUpClass', 'tearDownClass']:
+                self.handle_fixture_error(test, err, function_name, path)
             else:
                 print('不支持处理该错误 %s' %function_name)
 
+    @outcome
     def addFailure(self, test, err):
-        super().addFailure(test, err)
-        self.register(test, 'FAIL', self._exc_info_to_string(err, test))
-
+        exec_info = self._exc_info_to_string(err, test)
+        if self.hold_for_rerun(test, 'FAIL', exec_info):
+            return
+        self.failures.append((test.id(), exec_info))
+        if self.failfast:
+            self.stop()
+        self.register(test, 'FAIL', exec_info)
+
+    @outcome
     def addSuccess(self, test):
-        self.success.append(test)
+        self.success.append(test.id())
         self.register(test, 'PASS')
 
+    @outcome
     def addSkip(self, test, reason):
-        super().addSkip(test, reason)
+        self.skipped.append((test.id(), reason))
         self.register(test, 'SKIPPED', reason)
 
+    @outcome
     def addExpectedFailure(self, test, err):
-        super().addExpectedFailure(test, err)
-        self.register(test, 'XFAIL', self._exc_info_to_string(err, test))
+        exec_info = self._exc_info_to_string(err, test)
+        self.expectedFailures.append((test.id(), exec_info))
+        self.register(test, 'XFAIL', exec_info)
 
+    @outcome
     def addUnexpectedSuccess(self, test):
-        super().addUnexpectedSuccess(test)
+        self.unexpectedSuccesses.append(test.id())
+        if self.failfast:
+            self.stop()
         self.register(test, 'XPASS', 'UnexpectedSuccess')
 
 
+def load_results(paths):
+    """读取多个分片导出的JSON Lines结果, 合并为一个Result"""
+    result = Result()
+    start_at, end_at = [], []
+    for path in paths:
+        records = {}
+        for data in read_jsonl(path):
+            if data['type'] == 'run':
+                start_at.append(datetime.fromisoformat(data['start_at']))
+                end_at.append(datetime.fromisoformat(data['end_at']))
+                result.testsRun += data['run_num']
+            else:
+                records[data['full_path']] = data  # 同一用例以最后一行为准
+        result.merge_records([TestRecord.from_dict(data) for data in records.values()])
+    result.start_at = min(start_at) if start_at else datetime.now()
+    result.end_at = max(end_at) if end_at else result.start_at
+    result.complete_run()
+    return result
+
+
+def load_durations(paths):
+    """从历史JSON Lines结果中读取用例耗时, 用于分片均衡"""
+    durations = {}
+    for path in paths:
+        for data in read_jsonl(path):
+            if data['type'] == 'test':
+                durations[data['full_path']] = data['duration']
+    return durations
+
+
+class WorkerResult(Result):
+    """子进程中使用: 用例开始时回传其超时时间, 用例结束(或在用例之外登记)后立即回传记录, 不在子进程中累积结果"""
+    def __init__(self, conn, timeout=None):
+        super().__init__()
+        self.conn = conn
+        self.timeout = timeout
+        self.running = False
+        self.eager = False  # 当前用例设置了超时, 输出直接写入文件, 被杀掉时父进程从文件读取
+
+    def startTest(self, test):
+        timeout = test_timeout(test, self.timeout)
+        self.eager = timeout is not None
+        self.running = True
+        super().startTest(test)
+        self.conn.send(('start', (test.id(), timeout, self.output.path if self.eager else None)))
+
+    def capture_output(self, name='output', eager=False):
+        super().capture_output(name, eager or self.eager)
+
+    def stopTest(self, test):
+        super().stopTest(test)
+        self.running = False
+        self.ship()
+
+    def complete_class(self, name):  # 记录已回传, 类是否完成由父进程判断
+        pass
+
+    def add_item(self, item):
+        super().add_item(item)
+        if not self.running:  # 用例中的登记在stopTest时回传, 以包含tearDown中添加的附件
+            self.ship()
+
+    def ship(self):
+        self.conn.send(('records', self.pop_records()))
+
+
+class ProcessWorker(object):
+    """进程池中的一个子进程, 记录分配的用例和正在执行的用例, 用例超时时杀掉进程并为剩余用例重启"""
+    def __init__(self, context, specs, timeout=None, options=None):
+        self.context = context
+        self.specs = specs
+        self.timeout = timeout
+        self.options = options  # 子进程中Result的配置, 见Result.options
+        self.done = set()  # 已回传结果的用例
+        self.start()
+
+    def start(self):
+        self.current = None  # (用例id, 开始时间, 超时时间, 输出文件)
+        self.conn, child_conn = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(target=run_specs_in_process,
+                                            args=(self.specs, child_conn, self.timeout, self.options), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def deadline(self):
+        return self.current[1] + self.current[2] if self.current else None
+
+    def receive(self, result):
+        """处理子进程的一条消息, 子进程结束时返回False"""
+        try:
+            event, data = self.conn.recv()
+        except EOFError:
+            return False
+        if event == 'start':
+            test_id, timeout, path = data
+            self.current = (test_id, time.monotonic(), timeout, path) if timeout else None
+            if isinstance(result, Result):
+                result.emit('start_test', {'id': test_id, 'time': time.time()})
+        elif event == 'records':
+            records, tests_run = data
+            self.done.update(item.full_path for item in records)
+            self.merge(result, records, tests_run)
+        elif event == 'done' and data is not None:  # 子进程中的fixture耗时和按类的cProfile统计
+            result.instrument.merge(data)
+        return event != 'done'
+
+    def merge(self, result, records, tests_run=0):
+        """合并子进程的记录, 子进程中的Result不发出事件, 在这里发出; 普通TestResult只合并执行数和各结果列表"""
+        if not isinstance(result, Result):
+            result.testsRun += tests_run
+            for item in records:
+                add_outcome(result, item.full_path, item.status, item.exec_info)
+            return
+        for item in result.merge_records(records, tests_run):
+            result.emit('register', item)
+
+    def restart(self, result):
+        """杀掉超时的子进程并登记TIMEOUT, 剩余用例在新进程中继续执行, 没有剩余用例时返回False"""
+        test_id, _, timeout, path = self.current
+        self.process.kill()
+        self.process.join()
+        while self.conn.poll() and self.receive(result):  # 被杀掉前已发出的消息
+            pass
+        self.conn.close()
+        specs = []
+        for module_name, class_name, method_names in self.specs:
+            names = []
+            for name in method_names:
+                full_path = '%s.%s.%s' % (module_name, class_name, name)
+                if full_path == test_id and full_path not in self.done:
+                    self.done.add(full_path)
+                    output, log = read_capture(path, (self.options or {}).get('output_limit', 1 << 20))
+                    self.merge(result, [worker_crash_record(
+                        module_name, class_name, name, self.process.exitcode, status='TIMEOUT',
+                        exec_info='TimeoutError: test timed out after %ss, worker process killed' % timeout,
+                        output=output, log=log)], 1)
+                elif full_path not in self.done:
+                    names.append(name)
+            if names:
+                specs.append((module_name, class_name, names))
+        self.specs = specs
+        if not specs:
+            return False
+        self.start()
+        return True
+
+    def report_crash(self, result):
+        self.process.join()
+        self.conn.close()
+        for module_name, class_name, method_names in self.specs:
+            for name in method_names:
+                if '%s.%s.%s' % (module_name, class_name, name) not in self.done:
+                    self.merge(result, [worker_crash_record(module_name, class_name, name,
+                                                            self.process.exitcode)])
+
+
 class Runner(object):
+    timeout = None  # 默认的用例超时时间(秒), 为None时只对设置了timeout的用例生效
+    start_method = None  # 进程池的启动方式(fork/forkserver/spawn), 默认为平台默认值
+
     def collect_only(self, suite):
+        """打印收集到的用例, suite为TestIndex时不导入用例模块"""
         t0 = time.time()
-        i = 0
-        suite = flatten_suite(suite)
-        print("Collect {} tests is {:.3f}s".format(suite.countTestCases(),time.time()-t0))
+        if isinstance(suite, TestIndex):
+            cases = ['%s (%s.%s)' % (entry['name'], entry['module'], entry['test_class'])
+                     for entry in suite.tests.values()]
+        else:
+            cases = [str(case) for case in flatten_suite(suite) if _isnotsuite(case)]
+        print("Collect {} tests is {:.3f}s".format(len(cases),time.time()-t0))
         print("-"*50)
-        for case in suite:
-            if _isnotsuite(case):
-                i += 1
-                print("{}.{}".format(i, str(case)))
+        for i, case in enumerate(cases, 1):
+            print("{}.{}".format(i, case))
         print("-"*50)
         
     def run_suite(self, suite, result, run_func=None, interval=None):
         topLevel = False
         if getattr(result, '_testRunEntered', False) is False:
             result._testRunEntered = topLevel = True
+            if isinstance(result, Result):
+                result.index_tests(suite)
 
         for index, test in enumerate(suite):
             if _isnotsuite(test):
@@ -385,85 +1402,552 @@ class Runner(object):
             self.run_suite(suite, result, run_func=run_func, interval=interval)
 
 
-    def run_suite_in_thread_poll(self, suite, result, thread_num=3, interval=None):
-        poll = ThreadPoolExecutor(max_workers=thread_num)
-        self.run_suite(suite, result, 
-                       run_func=lambda case, result: poll.submit(case, result), 
-                       interval=interval)
+    def run_class_suite(self, suite, result, interval=None):
+        """执行单个类的用例, 只处理类级fixture, 模块级fixture由调用方负责"""
+        result._moduleSetUpFailed = False
+        if isinstance(result, Result):
+            result.index_tests(suite)
+        for test in suite:
+            run_fixture(result, 'setUpClass', test.__class__, suite._handleClassSetUp, test, result)
+            result._previousTestClass = test.__class__
+            if getattr(test.__class__, '_classSetupFailed', False):
+                continue
+            self.run_test(test, result)
+            time.sleep(interval) if interval else None
+        run_fixture(result, 'tearDownClass', result._previousTestClass, suite._tearDownPreviousClass, None, result)
+        return result
+
+    def run_suite_in_thread_poll(self, suite, result, thread_num=3, interval=None, durations=None, first=()):
+        """按类分组在线程池中执行, 每组使用单独的Result, 按完成顺序在主线程中合并, 有历史耗时时耗时长的先执行
+        first中的用例(如上次失败的用例)所在的类最先执行"""
+        weight = duration_weight(durations)
+        if isinstance(result, Result):  # 模块级fixture在主线程中用result执行
+            result.index_tests(suite)
+        modules = defaultdict(list)
+        for class_suite in sorted(group_suites_by_class(suite), reverse=True,
+                                  key=lambda x: (any(test.id() in first for test in x), weight(x))):
+            modules[suite_module(class_suite)].append(class_suite)
+
+        def run_class(class_suite):
+            if isinstance(result, Result):
+                child = Result(result.verbosity)
+                vars(child).update(result.options())
+            else:
+                child = unittest.TestResult()
+            return self.run_class_suite(class_suite, child, interval=interval)
+
+        fixture_suite = unittest.TestSuite()
+        with ThreadPoolExecutor(max_workers=thread_num) as poll:
+            futures = {}  # future -> 所在模块的第一个用例
+            remaining = {}  # 模块 -> 未合并的类数, 模块的类都合并后执行tearDownModule
+            for module_name, class_suites in modules.items():  # 模块级fixture在主线程中执行一次
+                first_test = next(iter(class_suites[0]))
+                result._previousTestClass = None
+                run_fixture(result, 'setUpModule', module_name, fixture_suite._handleModuleFixture, first_test, result)
+                if result._moduleSetUpFailed:
+                    continue
+                remaining[module_name] = len(class_suites)
+                for class_suite in class_suites:
+                    futures[poll.submit(run_class, class_suite)] = first_test
+
+            for future in as_completed(futures):  # 慢的类不阻塞先完成的类的合并, 类完成和流式写入
+                merge_result(result, future.result())
+                first_test = futures.pop(future)
+                module_name = first_test.__class__.__module__
+                remaining[module_name] -= 1
+                if remaining[module_name]:
+                    continue
+                result._previousTestClass = first_test.__class__
+                result._moduleSetUpFailed = False
+                run_fixture(result, 'tearDownModule', module_name, fixture_suite._handleModuleTearDown, result)
+        result._previousTestClass = None
+        return result
+
+    def run_suite_in_process_pool(self, suite, result, workers=None, durations=None):
+        """按类分片到多个进程执行, 类和模块级fixture在每个进程中只执行一次, 按历史耗时均衡分片
+        用例超时时杀掉所在进程, 该进程剩余的用例在新进程中继续执行"""
+        workers = workers or os.cpu_count() or 1
+        if isinstance(result, Result):  # 子进程按用例回传记录, 各类交错到达, 按索引的用例数判断类是否完成
+            result.index_tests(suite)
+        suite_list = []
+        for class_suite in group_suites_by_class(suite):
+            if isinstance(next(iter(class_suite)), unittest.loader._FailedTest):  # 导入失败的模块无法在子进程中重新加载
+                class_suite(result)
+            else:
+                suite_list.append(class_suite)
+        shards = partition_suites(suite_list, workers, weight=duration_weight(durations))
+        context = multiprocessing.get_context(self.start_method)
+        if context.get_start_method() == 'forkserver':  # forkserver先导入reportz和用例模块, 子进程从它fork时无需再导入
+            context.set_forkserver_preload(['reportz'] + sorted({suite_module(suite) for shard in shards
+                                                                 for suite in shard}))
+        options = result.options() if isinstance(result, Result) else None
+        workers = [ProcessWorker(context, [suite_spec(suite) for suite in shard], self.timeout, options)
+                   for shard in shards if shard]
+
+        running = list(workers)
+        while running:
+            deadlines = [worker.deadline for worker in running if worker.current]
+            wait_timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+            conns = {worker.conn: worker for worker in running}
+            for conn in wait(list(conns), wait_timeout):
+                if not conns[conn].receive(result):
+                    running.remove(conns[conn])
+            now = time.monotonic()
+            for worker in list(running):
+                if worker.current and worker.deadline <= now and not worker.restart(result):
+                    running.remove(worker)
+
+        for worker in workers:
+            worker.report_crash(result)
+        return result
+
+    def run_test(self, test, result):
+        """执行单个用例, 失败且还有重试次数时(见Result.hold_for_rerun)重新执行"""
+        self.run_once(test, result)
+        while test.id() in getattr(result, 'rerun_pending', ()):
+            result.rerun_pending.discard(test.id())
+            self.run_once(test, result)
+        return result
+
+    def run_once(self, test, result):
+        """设置了超时的用例交给run_with_timeout, 子进程中的超时由父进程监控"""
+        timeout = None if isinstance(result, WorkerResult) else test_timeout(test, self.timeout)
+        if timeout is None:
+            return test(result)
+        return self.run_with_timeout(test, result, timeout)
 
     def run_with_timeout(self, test, result, timeout):
-        print(test, result, timeout)
-        set_timeout(timeout, result.addTimeout)(test)(result)
+        """在独立上下文的守护线程中执行, 当前线程作为监控, 超时后登记TIMEOUT(保留已捕获的输出)并放弃等待"""
+        context = contextvars.Context()
+        thread = threading.Thread(target=context.run, args=(test, result), daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if not thread.is_alive():
+            return result
+        async_raise(thread, TimeoutError)
+        if isinstance(result, Result):
+            result.addTimeout(test, timeout, context.get(result._output))
+        else:
+            result.errors.append((test, 'TimeoutError: test timed out after %ss' % timeout))
+        return result
 
-    def run(self, suite, callback=None):
-        result = Result()
+    def run_suite_in_asyncio(self, suite, result, concurrency=10):
+        """在一个事件循环中并发执行异步用例(IsolatedAsyncioTestCase或协程方法), 最多同时执行concurrency个,
+        模块依次执行, 同一模块的类并发执行, 模块和类级fixture各执行一次; 同步用例在事件循环中直接执行(会阻塞其他用例)"""
+        if getattr(result, 'coverage', None) is not None:  # sys.settrace按线程生效, 并发的用例无法区分
+            concurrency = 1
+        result.index_tests(suite)
+        asyncio.run(self.run_modules_async(suite, result, asyncio.Semaphore(concurrency)))
+        return result
+
+    async def run_modules_async(self, suite, result, semaphore):
+        modules = defaultdict(list)
+        for class_suite in group_suites_by_class(suite):
+            modules[suite_module(class_suite)].append(class_suite)
+        fixture_suite = unittest.TestSuite()
+        for class_suites in modules.values():
+            first_test = next(iter(class_suites[0]))
+            result._previousTestClass = None
+            run_fixture(result, 'setUpModule', first_test.__class__.__module__,
+                        fixture_suite._handleModuleFixture, first_test, result)
+            if result._moduleSetUpFailed:
+                continue
+            await asyncio.gather(*(self.run_class_async(class_suite, result, semaphore)
+                                   for class_suite in class_suites))
+            result._previousTestClass = first_test.__class__
+            result._moduleSetUpFailed = False
+            run_fixture(result, 'tearDownModule', first_test.__class__.__module__,
+                        fixture_suite._handleModuleTearDown, result)
+        result._previousTestClass = None
+
+    async def run_class_async(self, suite, result, semaphore):
+        """类级fixture在事件循环中同步执行, 期间不会切换到其他任务, 因此可以共用result上的fixture状态"""
+        tests = list(suite)
+        test_class = tests[0].__class__
+        result._previousTestClass = None
+        result._moduleSetUpFailed = False
+        run_fixture(result, 'setUpClass', test_class, suite._handleClassSetUp, tests[0], result)
+        if not getattr(test_class, '_classSetupFailed', False):
+            await asyncio.gather(*(self.run_test_async(test, result, semaphore) for test in tests))
+        result._previousTestClass = test_class
+        run_fixture(result, 'tearDownClass', test_class, suite._tearDownPreviousClass, None, result)
+
+    async def run_test_async(self, test, result, semaphore):
+        """每个用例是单独的任务, 输出按任务的上下文分别捕获"""
+        async with semaphore:
+            if not is_async_test(test):
+                self.run_test(test, result)
+                return
+            await self.run_async_once(test, result)
+            while test.id() in result.rerun_pending:
+                result.rerun_pending.discard(test.id())
+                await self.run_async_once(test, result)
+
+    async def run_async_once(self, test, result):
+        """对应TestCase.run: setUp, asyncSetUp, 用例协程, asyncTearDown, tearDown和cleanups(异步的cleanup会await),
+        超时时取消用例协程并登记TIMEOUT"""
+        method = getattr(test, test._testMethodName)
+        result.startTest(test)
+        try:
+            if getattr(test.__class__, '__unittest_skip__', False) or getattr(method, '__unittest_skip__', False):
+                result.addSkip(test, getattr(test.__class__, '__unittest_skip_why__', '')
+                               or getattr(method, '__unittest_skip_why__', ''))
+                return
+            expecting_failure = (getattr(method, '__unittest_expecting_failure__', False)
+                                 or getattr(test, '__unittest_expecting_failure__', False))
+            timeout = test_timeout(test, self.timeout)
+            outcome = []  # (类型, 异常信息), 类型为skip/fail/error
+
+            async def step(function, *args):
+                try:
+                    await call_maybe_async(function, *args)
+                    return True
+                except (KeyboardInterrupt, asyncio.CancelledError):
+                    raise
+                except unittest.SkipTest as e:
+                    outcome.append(('skip', str(e)))
+                except test.failureException:
+                    outcome.append(('fail', sys.exc_info()))
+                except BaseException:
+                    outcome.append(('error', sys.exc_info()))
+                return False
+
+            timed_out = False
+            if await step(test.setUp) and await step(getattr(test, 'asyncSetUp', noop)):
+                try:
+                    await asyncio.wait_for(step(method), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                await step(getattr(test, 'asyncTearDown', noop))
+                await step(test.tearDown)
+            while test._cleanups:
+                function, args, kwargs = test._cleanups.pop()
+                await step(functools.partial(function, *args, **kwargs))
+
+            if timed_out:
+                result.addTimeout(test, timeout)
+            elif not outcome:
+                result.addUnexpectedSuccess(test) if expecting_failure else result.addSuccess(test)
+            for kind, info in outcome:
+                if kind == 'skip':
+                    result.addSkip(test, info)
+                elif expecting_failure:
+                    result.addExpectedFailure(test, info)
+                elif kind == 'fail':
+                    result.addFailure(test, info)
+                else:
+                    result.addError(test, info)
+        finally:
+            result.stopTest(test)
+
+    def run(self, suite, callback=None, workers=None, thread_num=None, result=None, history=None,
+            reruns=0, last_failed=None, failed_first=False, coverage=None, changed=None, concurrency=None):
+        """last_failed为LastFailed时执行后保存失败的用例, failed_first为True时这些用例先执行;
+        coverage为CoverageMap时记录并保存每个用例调用过的文件, 同时给出changed(变更的文件列表)时只执行受影响的用例;
+        concurrency为异步用例在事件循环中的并发数(见run_suite_in_asyncio)"""
+        if result is None:
+            result = Result()
+        if coverage is not None:
+            if changed is not None:
+                suite = coverage.select(suite, changed)
+            result.coverage = coverage
+            result.add_listener(coverage)
+        durations = None
+        if history is not None:
+            result.listeners.insert(0, history)  # 先于报告写入者保存, 流式/分页报告中的趋势包含本次执行
+            durations = history.durations
+        failed = ()
+        if last_failed is not None:
+            if failed_first:
+                failed = last_failed.ids
+                suite = order_failed_first(suite, failed)
+            result.add_listener(last_failed)
+        result.reruns = reruns
         result.start_at = datetime.now()
-        self.run_suite(suite, result)
+        if result.events is not None:
+            result.add_listener(result.events)
+            result.emit('run_start', {'total': suite.countTestCases(), 'time': time.time()})
+        if workers:
+            self.run_suite_in_process_pool(suite, result, workers=workers, durations=durations)
+        elif thread_num:
+            self.run_suite_in_thread_poll(suite, result, thread_num=thread_num, durations=durations, first=failed)
+        elif concurrency:
+            self.run_suite_in_asyncio(suite, result, concurrency=concurrency)
+        else:
+            self.run_suite(flatten_suite(suite), result, run_func=self.run_test)
         result.end_at = datetime.now()
+        result.complete_run()
         if callback:
             callback(result)
         return result
 
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+STATUS_GROUPS = {'PASS': 0, 'XFAIL': 0, 'FAIL': 1, 'XPASS': 1, 'ERROR': 2, 'TIMEOUT': 2}
+
+
+def format_duration(value, unit='s'):
+    if isinstance(value, timedelta):
+        value = value.total_seconds()
+    return '%.3f%s' % (value or 0, unit)
+
+
+def status_class(status, pass_class='', fail_class='', error_class='', skip_class=''):
+    """按状态分组返回对应的值, 如 {{test.status|status_class('table-success', 'table-danger', 'table-warning', 'table-secondary')}}"""
+    group = STATUS_GROUPS.get(status, 2 if status.endswith('_ERROR') else 3)  # setUpClass_ERROR, LOAD_ERROR等为出错
+    return (pass_class, fail_class, error_class, skip_class)[group]
+
+
+@functools.lru_cache(maxsize=None)
+def template_env(*template_dirs):
+    """按模板目录缓存Environment, 用户目录优先于内置templates目录, 编译结果缓存在临时目录"""
+    env = Environment(loader=FileSystemLoader(list(template_dirs) + [TEMPLATE_DIR]),
+                      bytecode_cache=FileSystemBytecodeCache())
+    env.filters['duration'] = format_duration
+    env.filters['status_class'] = status_class
+    env.filters['relpath'] = os.path.relpath
+    return env
+
+
+def slowest_tests(records, num, durations=None):
+    """耗时最长的num个用例, 附带历史耗时"""
+    durations = durations or {}
+    records = heapq.nlargest(num, (record for record in records if record.duration), key=lambda x: x.duration)
+    return [dict(test=record, history=durations.get(record.full_path)) for record in records]
+
+
+def history_context(history, trend=30, flaky=20):
+    """history为RunHistory时报告中的执行趋势, 不稳定用例和本次执行的耗时退化"""
+    if not isinstance(history, RunHistory):
+        return {}
+    return {'trend': history.trend(trend), 'flaky_tests': history.flaky(flaky), 'regressions': history.regressions}
+
+
+def result_stats(result):
+    stats = result.stats
+    return {
+        "total": stats['total'],
+        "run_num": result.testsRun,
+        "pass_num": stats['pass_num'],
+        "fail_num": stats['fail_num'],
+        "skipped_num": stats['skipped_num'],
+        "error_num": stats['error_num'],
+        "xfail_num": stats['xfail_num'],
+        "xpass_num": stats['xpass_num'],
+        "timeout_num": stats['timeout_num'],
+        "rerun_num": stats['rerun_num'],
+        "start_at": result.start_at,
+        "end_at": result.end_at,
+        "duration": result.end_at - result.start_at,
+    }
+
+
+class StreamReportWriter(object):
+    """流式报告: 模板需定义head, test_class, tail三个block, 每个类执行完即渲染写入, 汇总数据写在tail中"""
+    def __init__(self, path, template, context, slowest=0, durations=None, history=None):
+        missing = {'head', 'test_class', 'tail'} - set(template.blocks)
+        if missing:
+            raise ValueError('template does not support streaming, missing blocks: %s' % ', '.join(sorted(missing)))
+        self.template = template
+        self.context = context
+        self.slowest = slowest
+        self.slowest_records = []
+        self.durations = durations
+        self.history = history
+        self.file = open(path, 'w')
+        self.write('head', start_at=datetime.now())
+
+    def write(self, block, **kwargs):
+        context = self.template.new_context(dict(self.context, **kwargs))
+        for chunk in self.template.blocks[block](context):
+            self.file.write(chunk)
+        self.file.flush()
+
+    def class_complete(self, test_class):
+        self.write('test_class', test_class=test_class)
+        if self.slowest:
+            self.slowest_records = heapq.nlargest(self.slowest, self.slowest_records + test_class['test_cases'],
+                                                  key=lambda x: x.duration or timedelta())
+
+    def run_complete(self, result):
+        self.write('tail', slowest_tests=slowest_tests(self.slowest_records, self.slowest, self.durations),
+                   failure_clusters=result.clusters.summary(), **history_context(self.history),
+                   **result_stats(result))
+        self.file.close()
+
+
+class PagedReportWriter(object):
+    """分页报告: 每个类执行完即把其用例压缩写入<报告名>_data/<序号>.js, 执行完成后渲染只含汇总和类列表的HTML,
+    浏览器展开某个类时才用script标签加载该类的数据(file://下也可用), 长列表虚拟滚动"""
+    def __init__(self, path, template, context, slowest=0, durations=None, history=None):
+        self.path = path
+        self.template = template
+        self.context = context
+        self.slowest = slowest
+        self.slowest_records = []
+        self.durations = durations
+        self.history = history
+        self.report_dir = os.path.dirname(os.path.abspath(path))
+        self.data_dir = os.path.splitext(path)[0] + '_data'
+        self.classes = []
+        os.makedirs(self.data_dir, exist_ok=True)
+        for name in os.listdir(self.data_dir):  # 清理上次执行的数据
+            if name.endswith('.js'):
+                os.remove(os.path.join(self.data_dir, name))
+
+    def test_data(self, record):
+        return {
+            'sn': record.sn,
+            'name': record.full_name,
+            'doc': record.doc,
+            'status': record.status,
+            'duration': record.duration.total_seconds() if record.duration else 0,
+            'output': record.output,
+            'exec_info': None if record.failure else record.exec_info,  # 失败只给出异常行, 完整traceback在聚类中
+            'failure': record.failure,
+            'exception': record.exception,
+            'log': os.path.relpath(record.log, self.report_dir) if record.log else None,
+            'attempts': len(record.attempts),
+            'attachments': [dict(item, path=os.path.relpath(item['path'], self.report_dir).replace(os.sep, '/'))
+                            for item in record.attachments],
+        }
+
+    def class_complete(self, test_class):
+        index = len(self.classes)
+        data = json.dumps([self.test_data(record) for record in test_class['test_cases']],
+                          ensure_ascii=False, default=str)
+        payload = base64.b64encode(gzip.compress(data.encode('utf-8'), mtime=0)).decode('ascii')
+        path = os.path.join(self.data_dir, '%d.js' % index)
+        with open(path, 'w') as f:
+            f.write('reportzChunk(%d, "%s");\n' % (index, payload))
+        summary = {key: value for key, value in test_class.items() if key != 'test_cases'}
+        summary['duration'] = test_class['duration'].total_seconds()
+        summary['chunk'] = os.path.relpath(path, self.report_dir).replace(os.sep, '/')
+        self.classes.append(summary)
+        if self.slowest:
+            self.slowest_records = heapq.nlargest(self.slowest, self.slowest_records + test_class['test_cases'],
+                                                  key=lambda x: x.duration or timedelta())
+
+    def run_complete(self, result):
+        context = dict(self.context, classes=self.classes,
+                       slowest_tests=slowest_tests(self.slowest_records, self.slowest, self.durations),
+                       failure_clusters=result.clusters.summary(), **history_context(self.history),
+                       **result_stats(result))
+        with open(self.path, 'w') as f:
+            f.write(self.template.render(context))
+
+
 class HTMLRunner(Runner):
-    def __init__(self, output, title="Test Report", description="", tester="",template='simple', **kwargs):
+    def __init__(self, output, title="Test Report", description="", tester="",template='simple', stream=False,
+                 paged=False, template_dirs=None, listeners=None, history=None, slowest=10, timeout=None,
+                 reruns=0, last_failed=None, failed_first=False, output_limit=1 << 20, echo=True, instrument=None,
+                 coverage=None, changed=None, events=None, start_method=None, **kwargs):
         self.file = datetime.now().strftime(output)
         self.title = title
         self.description = description
         self.tester = tester
         self.template = template
+        self.template_dirs = tuple(template_dirs or ())
+        self.stream = stream
+        self.paged = paged  # 分页报告, 使用paged模板, 用例数据写入报告旁的<报告名>_data目录
+        self.listeners = list(listeners or [])
+        self.history = history  # DurationHistory或RunHistory, 为RunHistory时报告中包含执行趋势和不稳定用例
+        self.slowest = slowest
         self.kwargs = kwargs
-        self.timeout = 10
-
-    def generate_report(self, result):
-        basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        template_path = os.path.join(basedir, 'templates', '%s.html' % self.template)
-
-        with open(template_path) as f:
-            template_content = f.read()
-        
-        test_classess = result.sortByClass()
-        
+        self.timeout = timeout
+        self.reruns = reruns
+        self.last_failed = last_failed
+        self.failed_first = failed_first
+        self.output_limit = output_limit  # 超出的输出写入报告旁的<报告名>_logs目录, 报告中只显示开头和结尾
+        self.log_dir = os.path.splitext(self.file)[0] + '_logs'
+        self.attachment_dir = os.path.splitext(self.file)[0] + '_attachments'
+        self.echo = echo
+        self.instrument = instrument
+        self.coverage = coverage
+        self.changed = changed
+        self.events = events  # EventBus, 执行过程中的实时进度
+        self.start_method = start_method
+
+    def load_template(self):
+        template = 'paged' if self.paged else self.template
+        return template_env(*self.template_dirs).get_template('%s.html' % template)
+
+    def paged_writer(self):
+        return PagedReportWriter(self.file, self.load_template(), self.report_context(), slowest=self.slowest,
+                                 durations=self.history.durations if self.history else None, history=self.history)
+
+    def report_context(self):
         report_config_info = { 
             "title": self.title,
             "description": self.description,
-            "tester": self.tester
+            "tester": self.tester,
+            "report_dir": os.path.dirname(os.path.abspath(self.file)),
             }
-        result_stats_info = {
-            "total": len(result.result),
-            "run_num": result.testsRun,
-            "pass_num": len(result.success),
-            "fail_num": len(result.failures),
-            "skipped_num": len(result.skipped),
-            "error_num": len(result.errors),
-            "xfail_num": len(result.expectedFailures),
-            "xpass_num": len(result.unexpectedSuccesses),
-            "rerun_num": 0,
-            "start_at": result.start_at,
-            "end_at": result.end_at,
-            "duration": result.end_at - result.start_at,
-        }
         env_info = {
             "platform": platform.platform(),
             "system": platform.system(),
             "python_version": platform.python_version(),
             "env": dict(os.environ),
         }
+        context = {}
+        [context.update(info) for info in (report_config_info, 
+                                           env_info, 
+                                           self.kwargs)]
+        return context
+
+    def generate_report(self, result):
+        if self.paged:
+            writer = self.paged_writer()
+            for test_class in result.sortByClass():
+                writer.class_complete(test_class)
+            writer.run_complete(result)
+            return
+        test_classess = result.sortByClass()
+        
+        result_stats_info = result_stats(result)
         context = {
             "result": result,
             "test_cases": result.result,
             "test_classes": test_classess,
+            "slowest_tests": slowest_tests(result.result.values(), self.slowest,
+                                           self.history.durations if self.history else None),
+            "profiled_tests": [record for record in result.result.values() if record.metrics],
+            "fixtures": self.instrument.slowest_fixtures() if self.instrument else [],
+            "failure_clusters": result.clusters.summary(),
         }
-        [context.update(info) for info in (report_config_info, 
-                                           result_stats_info, 
-                                           env_info, 
-                                           self.kwargs)]
+        context.update(result_stats_info)
+        context.update(history_context(self.history))
+        context.update(self.report_context())
         
-        content = Template(template_content).render(context)
+        content = self.load_template().render(context)
         with open(self.file, "w") as f:
             f.write(content)
 
-    def run(self, suite):
-        result = super().run(suite, callback=self.generate_report)
+    def run(self, suite, workers=None, thread_num=None, concurrency=None):
+        result = Result()
+        result.output_limit, result.log_dir, result.echo = self.output_limit, self.log_dir, self.echo
+        result.events = self.events
+        result.attachments = AttachmentStore(self.attachment_dir)
+        if self.instrument is not None:
+            result.instrument = self.instrument
+            result.add_listener(self.instrument)
+        for listener in self.listeners:
+            result.add_listener(listener)
+        if self.stream or self.paged:
+            result.keep_records = False
+            if self.paged:
+                result.add_listener(self.paged_writer())
+            else:
+                result.add_listener(StreamReportWriter(self.file, self.load_template(), self.report_context(),
+                                                       slowest=self.slowest,
+                                                       durations=self.history.durations if self.history else None,
+                                                       history=self.history))
+            return super().run(suite, workers=workers, thread_num=thread_num, result=result, history=self.history,
+                               reruns=self.reruns, last_failed=self.last_failed, failed_first=self.failed_first,
+                               coverage=self.coverage, changed=self.changed, concurrency=concurrency)
+        result = super().run(suite, callback=self.generate_report, workers=workers, thread_num=thread_num,
+                             result=result, history=self.history, reruns=self.reruns, last_failed=self.last_failed,
+                             failed_first=self.failed_first, coverage=self.coverage, changed=self.changed,
+                             concurrency=concurrency)
         return result
 
 
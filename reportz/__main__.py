@@ -0,0 +1,199 @@
+"""命令行入口
+
+    python -m reportz run tests --shard 1/4 --durations last/*.jsonl --jsonl shard1.jsonl
+    python -m reportz run tests --failed-first --reruns 2 -o report.html
+    python -m reportz run tests --run-history --regression 30 -o report.html
+    python -m reportz run tests --changed $(git diff --name-only origin/main)
+    python -m reportz run tests --workers 4 --live-report progress.html --live-port 8765
+    python -m reportz serve tests & python -m reportz run tests --pool --workers 4
+    python -m reportz collect tests --tag "smoke and not slow" --level "<=2"
+    python -m reportz merge shard*.jsonl -o report.html
+"""
+import argparse
+import os
+import sys
+import unittest
+
+from reportz import HTMLRunner, Runner, Result, JsonLinesExporter, JUnitExporter, DurationHistory, RunHistory, \
+    LastFailed, TestIndex, Instrumentation, CoverageMap, EventBus, LiveReport, LiveServer, shard_suite, load_results, \
+    load_durations
+from reportz.history import CACHE_DIR
+from reportz.pool import DEFAULT_ADDRESS, WarmPool, run_in_pool
+
+
+def parse_shard(value):
+    index, total = (int(i) for i in value.split('/'))
+    if not 1 <= index <= total:
+        raise argparse.ArgumentTypeError('shard should be i/N with 1 <= i <= N')
+    return index, total
+
+
+def load_suite(args):
+    """指定了tag/level时通过索引筛选, 只导入选中用例所在的模块"""
+    if args.tag or args.level is not None:
+        index = TestIndex(args.path, args.pattern)
+        return index.suite(index.select(tags=args.tag, level=args.level))
+    return unittest.defaultTestLoader.discover(args.path, pattern=args.pattern)
+
+
+def run(args):
+    suite = load_suite(args)
+    if args.run_history:
+        history = RunHistory(args.run_history, regression=args.regression / 100)
+    else:
+        history = DurationHistory(args.history) if args.history else None
+    if args.shard:
+        durations = history.durations if history else load_durations(args.durations)
+        suite = shard_suite(suite, *args.shard, durations=durations)
+    last_failed = LastFailed(args.last_failed) if args.last_failed else LastFailed()
+    coverage = None
+    if args.coverage or args.changed is not None:
+        coverage = CoverageMap(args.coverage_map)
+    options = dict(reruns=args.reruns, last_failed=last_failed, failed_first=args.failed_first,
+                   coverage=coverage, changed=args.changed)
+    instrument = None
+    if args.cpu or args.memory or args.profile:
+        instrument = Instrumentation(cpu=True, memory=args.memory, profile=args.profile, pstats_dir=args.pstats_dir)
+    events = None
+    if args.live_report or args.live_port is not None:
+        events = EventBus()
+        if args.live_report:
+            events.subscribe(LiveReport(args.live_report, title=args.title))
+        if args.live_port is not None:
+            server = LiveServer(port=args.live_port, title=args.title)
+            events.subscribe(server)
+            print('live progress at %s' % server.url, file=sys.stderr)
+    listeners = []
+    if args.jsonl:
+        listeners.append(JsonLinesExporter(args.jsonl))
+    if args.junit:
+        listeners.append(JUnitExporter(args.junit))
+
+    if args.output:
+        runner = HTMLRunner(args.output, title=args.title, template=args.template, paged=args.paged, listeners=listeners,
+                            history=history, output_limit=args.output_limit, echo=not args.no_echo,
+                            instrument=instrument, events=events, start_method=args.start_method, **options)
+        result = runner.run(suite, workers=args.workers, thread_num=args.threads, concurrency=args.concurrency)
+    else:
+        result = Result()
+        result.output_limit, result.echo, result.events = args.output_limit, not args.no_echo, events
+        if instrument is not None:
+            result.instrument = instrument
+            listeners.append(instrument)
+        for listener in listeners:
+            result.add_listener(listener)
+        runner = Runner()
+        runner.start_method = args.start_method
+        runner.run(suite, workers=args.workers, thread_num=args.threads, result=result, history=history,
+                   concurrency=args.concurrency, **options)
+    if isinstance(history, RunHistory):
+        for item in history.regressions:
+            print('%s got slower: %.3fs, baseline %.3fs' % (item['test_id'], item['duration'], item['baseline']),
+                  file=sys.stderr)
+    if coverage is not None and coverage.fallback:
+        print('coverage map is missing or stale, ran the full suite', file=sys.stderr)
+    return 0 if result.wasSuccessful() else 1
+
+
+def serve(args):
+    WarmPool(args.path, args.pattern, address=args.address).serve_forever()
+    return 0
+
+
+def collect(args):
+    index = TestIndex(args.path, args.pattern)
+    if args.tag or args.level is not None:
+        for test_id in index.select(tags=args.tag, level=args.level):
+            print(test_id)
+    else:
+        Runner().collect_only(index)
+    return 0
+
+
+def merge(args):
+    result = load_results(args.paths)
+    HTMLRunner(args.output, title=args.title, template=args.template, paged=args.paged).generate_report(result)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='reportz')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='discover and run tests')
+    parser_run.add_argument('path', nargs='?', default='.')
+    parser_run.add_argument('-p', '--pattern', default='test*.py')
+    parser_run.add_argument('-o', '--output', help='html report path, supports strftime format')
+    parser_run.add_argument('-t', '--template', default='simple')
+    parser_run.add_argument('--paged', action='store_true', help='html shell plus per-class data loaded on demand')
+    parser_run.add_argument('--title', default='Test Report')
+    parser_run.add_argument('--workers', type=int, help='run in a process pool')
+    parser_run.add_argument('--threads', type=int, help='run in a thread pool')
+    parser_run.add_argument('--concurrency', type=int, help='run async tests concurrently on one event loop')
+    parser_run.add_argument('--shard', type=parse_shard, help='only run shard i of N, e.g. 1/4')
+    parser_run.add_argument('--durations', nargs='*', default=[], help='jsonl results used to balance shards')
+    parser_run.add_argument('--history', help='duration history db, used to schedule the longest tests first')
+    parser_run.add_argument('--run-history', nargs='?', const=os.path.join(CACHE_DIR, 'history.db'),
+                            help='append each run to a history db, the report shows trends and flaky tests; '
+                                 'used instead of --history to schedule tests')
+    parser_run.add_argument('--regression', type=float, default=50,
+                            help='flag tests more than this percent slower than their recent p50, with --run-history')
+    parser_run.add_argument('--reruns', type=int, default=0, help='rerun failed tests up to N times')
+    parser_run.add_argument('--failed-first', action='store_true', help='run the tests failed last time first')
+    parser_run.add_argument('--last-failed', help='where failed test ids are kept, default .reportz/lastfailed.json')
+    parser_run.add_argument('--jsonl', help='stream results to a JSON Lines file')
+    parser_run.add_argument('--junit', help='write results to a JUnit XML file')
+    parser_run.add_argument('--output-limit', type=int, default=1 << 20,
+                            help='characters of output kept in memory per test, the rest is written to a log file')
+    parser_run.add_argument('--no-echo', action='store_true', help='do not echo captured output to the console')
+    parser_run.add_argument('--cpu', action='store_true', help='record cpu time of each test')
+    parser_run.add_argument('--memory', action='store_true', help='record peak and net allocation of each test')
+    parser_run.add_argument('--profile', choices=['test', 'class'], help='export cProfile stats per test or class')
+    parser_run.add_argument('--pstats-dir', default=os.path.join(CACHE_DIR, 'pstats'))
+    parser_run.add_argument('--tag', help='tag expression, e.g. "smoke and not slow"')
+    parser_run.add_argument('--level', help='level expression, e.g. 1, 1,2 or <=2')
+    parser_run.add_argument('--coverage', action='store_true', help='record the source files each test calls')
+    parser_run.add_argument('--changed', nargs='*',
+                            help='only run tests affected by these files, the full suite if the coverage map is stale')
+    parser_run.add_argument('--live-report', help='progress html rewritten during the run, refreshes itself')
+    parser_run.add_argument('--live-port', type=int, help='serve live progress and SSE events on this local port')
+    parser_run.add_argument('--coverage-map', default=os.path.join(CACHE_DIR, 'coverage.json'))
+    parser_run.add_argument('--start-method', choices=['fork', 'forkserver', 'spawn'],
+                            help='how worker processes are started, forkserver preloads the test modules')
+    parser_run.add_argument('--pool', action='store_true', help='run in the warm process started by `reportz serve`')
+    parser_run.add_argument('--pool-address', default=DEFAULT_ADDRESS)
+    parser_run.set_defaults(func=run)
+
+    parser_serve = subparsers.add_parser('serve', help='keep a warm process with the test modules imported')
+    parser_serve.add_argument('path', nargs='?', default='.')
+    parser_serve.add_argument('-p', '--pattern', default='test*.py')
+    parser_serve.add_argument('--address', default=DEFAULT_ADDRESS)
+    parser_serve.set_defaults(func=serve)
+
+    parser_collect = subparsers.add_parser('collect', help='list tests from the cached collection index')
+    parser_collect.add_argument('path', nargs='?', default='.')
+    parser_collect.add_argument('-p', '--pattern', default='test*.py')
+    parser_collect.add_argument('--tag', help='tag expression, e.g. "smoke and not slow"')
+    parser_collect.add_argument('--level', help='level expression, e.g. 1, 1,2 or <=2')
+    parser_collect.set_defaults(func=collect)
+
+    parser_merge = subparsers.add_parser('merge', help='merge jsonl results of shards into one report')
+    parser_merge.add_argument('paths', nargs='+')
+    parser_merge.add_argument('-o', '--output', default='report.html')
+    parser_merge.add_argument('-t', '--template', default='simple')
+    parser_merge.add_argument('--paged', action='store_true', help='html shell plus per-class data loaded on demand')
+    parser_merge.add_argument('--title', default='Test Report')
+    parser_merge.set_defaults(func=merge)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+    if args.command == 'run' and args.pool:
+        code = run_in_pool([arg for arg in argv if arg != '--pool'], args.pool_address)
+        if code is not None:
+            return code
+        print('warm pool is not available or stale, running locally', file=sys.stderr)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,113 @@
+"""用例附件(截图, 日志等): 按内容寻址保存在报告旁的目录中, 报告只引用文件
+
+    class LoginTest(reportz.AttachMixin, unittest.TestCase):
+        def test_login(self):
+            self.attach('page.png', driver.get_screenshot_as_png())
+            self.attach('server.log', '/var/log/app/server.log')
+"""
+import contextvars
+import gzip
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+
+TEXT_TYPES = ('text/', 'application/json', 'application/xml', 'application/javascript')
+TEXT_EXTENSIONS = ('.log', '.out', '.err', '.trace')  # mimetypes不认识的常见日志后缀
+
+current_test = contextvars.ContextVar('reportz_current_test', default=None)  # (Result, 正在执行的用例)
+
+
+class AttachmentStore(object):
+    """按内容寻址的附件目录: 文件名为内容的sha256, 相同内容只保存一份;
+    文件优先以硬链接(move为True时为rename)放入目录, 超过compress_size的文本gzip压缩保存"""
+    def __init__(self, directory, compress_size=16 * 1024):
+        self.directory = os.path.abspath(directory)
+        self.compress_size = compress_size
+
+    def target(self, digest, name, compressed):
+        extension = os.path.splitext(name)[1].lower()
+        directory = os.path.join(self.directory, digest[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, digest + extension + ('.gz' if compressed else ''))
+
+    def add(self, name, data, mime=None, move=False):
+        """data为bytes或文件路径, 返回附件信息dict(name, path, mime, size, sha256, compressed)"""
+        mime = mime or guess_mime(name)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+            digest, size = hashlib.sha256(data).hexdigest(), len(data)
+        else:
+            data = os.fspath(data)
+            digest, size = file_digest(data), os.path.getsize(data)
+        compressed = mime.startswith(TEXT_TYPES) and size > self.compress_size
+        path = self.target(digest, name, compressed)
+        if isinstance(data, bytes):
+            if not os.path.exists(path):
+                self.write(path, data, compressed)
+        elif os.path.exists(path) or compressed:
+            if not os.path.exists(path):
+                self.write(path, data, compressed)
+            if move:
+                os.remove(data)
+        else:
+            self.place(path, data, move)
+        return dict(name=name, path=path, mime=mime, size=size, sha256=digest, compressed=compressed)
+
+    def write(self, path, data, compressed):
+        if not isinstance(data, bytes):
+            with open(data, 'rb') as f:
+                data = f.read()
+        if compressed:
+            data = gzip.compress(data, mtime=0)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)  # 并发写入相同内容时结果一致
+
+    def place(self, path, source, move):
+        try:
+            if move:
+                os.replace(source, path)
+            else:
+                os.link(source, path)
+            return
+        except FileExistsError:  # 其他线程/进程刚写入了相同内容
+            return
+        except OSError:  # 跨文件系统或不支持硬链接
+            pass
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(fd)
+        (shutil.move if move else shutil.copyfile)(source, temp)
+        os.replace(temp, path)
+
+
+def guess_mime(name):
+    mime = mimetypes.guess_type(name)[0]
+    if mime is None and os.path.splitext(name)[1].lower() in TEXT_EXTENSIONS:
+        mime = 'text/plain'
+    return mime or 'application/octet-stream'
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def attach(name, data, mime=None, move=False):
+    """给当前执行的用例添加附件, data为bytes或文件路径, 在用例之外调用时抛出RuntimeError"""
+    current = current_test.get()
+    if current is None:
+        raise RuntimeError('attach() can only be called while a test is running')
+    result, test = current
+    return result.attach(test, name, data, mime, move)
+
+
+class AttachMixin(object):
+    """给TestCase添加self.attach(name, data)"""
+    def attach(self, name, data, mime=None, move=False):
+        return attach(name, data, mime, move)
@@ -0,0 +1,114 @@
+"""失败聚类: 登记时按规范化的traceback(异常类型 + 被测代码中的栈帧)给失败打指纹,
+每类失败只保存一份traceback, 报告中每类失败只渲染一次完整traceback, 用例行按指纹引用"""
+import hashlib
+import os
+import re
+import sys
+import sysconfig
+
+FRAME = re.compile(r'^  File "(.*)", line \d+, in (.*)$')
+CHAIN = re.compile(r'\n\n(?:The above exception was the direct cause of the following exception|'
+                   r'During handling of the above exception, another exception occurred):\n\n')
+NUMBER = re.compile(r'0x[0-9a-fA-F]+|\d+(?:\.\d+)?')
+PASSED = ('SKIPPED', 'XFAIL')  # 这些状态的exec_info是跳过原因/预期的失败, 不参与聚类
+LIBRARY_DIRS = tuple({os.path.normcase(os.path.abspath(path)) + os.sep
+                      for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+                      for path in [sysconfig.get_paths().get(name)] if path}
+                     | {os.path.normcase(os.path.dirname(os.path.abspath(__file__))) + os.sep})
+
+
+def parse_traceback(exec_info):
+    """返回最后一个(链式异常中最终抛出的)异常的栈帧[(文件, 函数)]和异常行"""
+    block = CHAIN.split(exec_info)[-1]
+    frames, exception = [], ''
+    for line in block.splitlines():
+        match = FRAME.match(line)
+        if match:
+            frames.append(match.groups())
+            exception = ''
+        elif line and not line.startswith(' ') and not exception and not line.startswith('Traceback '):
+            exception = line
+    if not exception and block.strip():
+        exception = block.strip().splitlines()[-1]
+    return frames, exception
+
+
+def exception_line(exec_info):
+    """traceback中最终的异常行, 如 AssertionError: 1 != 2"""
+    return parse_traceback(exec_info)[1] if exec_info else ''
+
+
+def is_library(path):
+    return path.startswith('<') or os.path.normcase(os.path.abspath(path)).startswith(LIBRARY_DIRS)
+
+
+def module_file(module_name):
+    path = getattr(sys.modules.get(module_name), '__file__', None)
+    return os.path.normcase(os.path.abspath(path)) if path else None
+
+
+def fingerprint(exec_info, test_file=None, root='.'):
+    """规范化的traceback: 异常类型, 以及去掉标准库/第三方库/reportz和用例文件本身后的栈帧(文件, 函数), 不含行号和异常信息,
+    因此调用同一个出错依赖的不同用例得到相同的指纹; 没有这样的栈帧时使用用例文件中最内层的栈帧,
+    没有栈帧(如超时)时使用数字替换为#的异常行. 返回规范化内容sha1的前12位"""
+    frames, exception = parse_traceback(exec_info)
+    exception_type = exception.split(':', 1)[0].strip()
+    tested = [(path, function) for path, function in frames if not is_library(path)]
+    code = [frame for frame in tested if os.path.normcase(os.path.abspath(frame[0])) != test_file]
+    frames = code or tested[-1:]
+    root = os.path.abspath(root)
+    if frames:
+        key = [exception_type] + ['%s:%s' % (relpath(path, root), function) for path, function in frames]
+    else:
+        key = [NUMBER.sub('#', exception)]
+    return hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest()[:12]
+
+
+def relpath(path, root):
+    path = os.path.abspath(path)
+    return os.path.relpath(path, root).replace(os.sep, '/') if path.startswith(root + os.sep) else path
+
+
+class FailureClusters(object):
+    """Result中登记的失败按指纹分组: 指纹 -> dict(id, exception, traceback, count, tests),
+    traceback为该类失败第一次出现时的完整内容, tests最多保留max_tests个用例id, 内存只随失败的种类增长"""
+    def __init__(self, root='.', max_tests=50):
+        self.root = root
+        self.max_tests = max_tests  # 每类最多记录的用例id, 其余只计数
+        self.clusters = {}
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def add(self, record):
+        """新登记的记录: 失败时设置failure(指纹)和exception(异常行)并计入聚类"""
+        if not record.exec_info or record.status in PASSED:
+            return
+        if record.failure is None:  # 子进程中登记的记录已带有指纹
+            record.failure = fingerprint(record.exec_info, module_file(record.test_module), self.root)
+        if record.exception is None:
+            record.exception = exception_line(record.exec_info)
+        cluster = self.clusters.get(record.failure)
+        if cluster is None:
+            cluster = self.clusters[record.failure] = dict(
+                id=record.failure, exception=record.exception, traceback=record.exec_info, count=0, tests=[])
+        elif record.exec_info == cluster['traceback']:  # 与代表traceback相同时共用一个字符串
+            record.exec_info = cluster['traceback']
+        cluster['count'] += 1
+        if len(cluster['tests']) < self.max_tests:
+            cluster['tests'].append(record.full_path)
+
+    def update(self, record):
+        """已登记的记录追加了异常信息(如tearDownClass出错): 此前未计入聚类时计入"""
+        if record.failure is None:
+            self.add(record)
+
+    def get(self, failure_id):
+        return self.clusters.get(failure_id)
+
+    def summary(self):
+        """按用例数从多到少排列的聚类"""
+        return sorted(self.clusters.values(), key=lambda cluster: -cluster['count'])
+
+    def clear(self):
+        self.clusters.clear()
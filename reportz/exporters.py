@@ -0,0 +1,92 @@
+"""执行过程中导出结果, 作为Result的监听者使用:
+
+    result.add_listener(JsonLinesExporter('result.jsonl'))
+    result.add_listener(JUnitExporter('junit.xml'))
+"""
+import re
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def xml_text(text):
+    return escape(INVALID_XML_CHARS.sub('', text or ''))
+
+
+def xml_attr(text):
+    return quoteattr(INVALID_XML_CHARS.sub('', str(text)))
+
+
+def read_jsonl(path):
+    """逐行读取JsonLinesExporter的输出, 忽略中途退出时未写完的最后一行"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class JsonLinesExporter(object):
+    """每登记一个用例写入一行JSON并flush, 中途退出时已执行的结果仍然可用.
+    同一用例再次更新时会重复写入, 读取时以最后一行为准, 最后一行type为run, 记录整体执行信息"""
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, data):
+        self.file.write(json.dumps(data, ensure_ascii=False, default=str))
+        self.file.write('\n')
+        self.file.flush()
+
+    def register(self, record):
+        data = record.to_dict()
+        data['type'] = 'test'
+        self.write(data)
+
+    update = register
+
+    def run_complete(self, result):
+        self.write(dict(type='run',
+                        start_at=result.start_at.isoformat(),
+                        end_at=result.end_at.isoformat(),
+                        run_num=result.testsRun))
+        self.file.close()
+
+
+class JUnitExporter(object):
+    """每个测试类执行完成后写入一个testsuite并flush"""
+    def __init__(self, path, name='reportz'):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites name=%s>\n' % xml_attr(name))
+        self.file.flush()
+
+    def class_complete(self, test_class):
+        self.file.write('<testsuite name=%s tests="%d" failures="%d" errors="%d" skipped="%d" time="%.3f">\n' % (
+            xml_attr(test_class['name']), test_class['total'],
+            test_class['fail_num'] + test_class['xpass_num'], test_class['error_num'],
+            test_class['skipped_num'] + test_class['xfail_num'], test_class['duration'].total_seconds()))
+        for record in test_class['test_cases']:
+            self.file.write(self.testcase(record))
+        self.file.write('</testsuite>\n')
+        self.file.flush()
+
+    def testcase(self, record):
+        time = record.duration.total_seconds() if record.duration else 0
+        lines = ['<testcase classname=%s name=%s time="%.3f">' % (
+            xml_attr(record.test_class), xml_attr(record.name), time)]
+        if record.status in ('FAIL', 'XPASS'):
+            lines.append('<failure message=%s>%s</failure>' % (xml_attr(record.status), xml_text(record.exec_info)))
+        elif record.status in ('SKIPPED', 'XFAIL'):
+            message = record.exec_info.strip().splitlines()
+            lines.append('<skipped message=%s/>' % xml_attr(message[-1] if message else ''))
+        elif record.status != 'PASS':
+            lines.append('<error message=%s>%s</error>' % (xml_attr(record.status), xml_text(record.exec_info)))
+        if record.output:
+            lines.append('<system-out>%s</system-out>' % xml_text(record.output))
+        lines.append('</testcase>\n')
+        return '\n'.join(lines)
+
+    def run_complete(self, result):
+        self.file.write('</testsuites>\n')
+        self.file.close()
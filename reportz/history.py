@@ -0,0 +1,227 @@
+"""执行历史的本地存储"""
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+CACHE_DIR = '.reportz'
+
+
+class DurationHistory(object):
+    """以test.id()为key在SQLite中保存用例耗时(指数滑动平均), 作为Result的监听者在每次执行后更新"""
+    def __init__(self, path=os.path.join(CACHE_DIR, 'durations.db'), alpha=0.5):
+        self.path = path
+        self.alpha = alpha
+        self.pending = {}
+        self._durations = None
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE IF NOT EXISTS durations '
+                     '(test_id TEXT PRIMARY KEY, duration REAL, last REAL, runs INTEGER)')
+        return conn
+
+    @property
+    def durations(self):
+        """用例id到历史耗时(秒)的映射, 为本次执行前的数据"""
+        if self._durations is None:
+            self._durations = {}
+            if os.path.exists(self.path):
+                with closing(self.connect()) as conn:
+                    self._durations = dict(conn.execute('SELECT test_id, duration FROM durations'))
+        return self._durations
+
+    def register(self, record):
+        if record.duration:
+            self.pending[record.full_path] = record.duration.total_seconds()
+
+    def run_complete(self, result):
+        self.save()
+
+    def save(self):
+        if not self.pending:
+            return
+        with closing(self.connect()) as conn, conn:
+            conn.executemany(
+                'INSERT INTO durations VALUES (?, ?, ?, 1) ON CONFLICT(test_id) DO UPDATE SET '
+                'duration = duration * ? + excluded.duration * ?, last = excluded.last, runs = runs + 1',
+                [(test_id, duration, duration, 1 - self.alpha, self.alpha)
+                 for test_id, duration in self.pending.items()])
+        self.pending = {}
+
+
+class LastFailed(object):
+    """保存最近一次执行中失败/出错的用例id, 作为Result的监听者在每次执行后更新, 本次未执行的用例保留上次的结果"""
+    PASSED = ('PASS', 'SKIPPED', 'XFAIL')
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'lastfailed.json')):
+        self.path = path
+        self.seen = set()
+        self.failed = []
+        self._ids = None
+
+    @property
+    def ids(self):
+        """上次失败的用例id, 按失败顺序"""
+        if self._ids is None:
+            self._ids = []
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    self._ids = json.load(f)
+        return self._ids
+
+    def register(self, record):
+        self.seen.add(record.full_path)
+        if record.status not in self.PASSED:
+            self.failed.append(record.full_path)
+
+    def run_complete(self, result):
+        self.save()
+
+    def save(self):
+        failed = [test_id for test_id in self.ids if test_id not in self.seen] + self.failed
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(failed, f, indent=0)
+        self._ids, self.seen, self.failed = failed, set(), []
+
+
+def quantile(values, q):
+    """已排序列表的分位数(最近秩)"""
+    return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+
+class RunHistory(object):
+    """多次执行的结果: 每次执行的汇总和各用例的状态/耗时追加到SQLite, 同时增量更新每个用例最近window次执行的
+    滚动统计(通过率, 状态翻转次数, p50/p95耗时), 报告中的趋势/不稳定用例/耗时退化只读取汇总和统计表, 与历史长度无关.
+    作为Result的监听者在每次执行后保存, 也可代替DurationHistory给出用例耗时(p50)用于调度"""
+    SKIPPED = ('SKIPPED',)
+    PASSED = ('PASS', 'XFAIL')
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'history.db'), window=50, keep_runs=200, regression=0.5,
+                 min_delta=0.1, min_runs=5):
+        self.path = path
+        self.window = window  # 滚动统计包含的最近执行次数
+        self.keep_runs = keep_runs  # 保留逐个用例结果的执行次数, 汇总和滚动统计不受影响
+        self.regression = regression  # 耗时超过基线(此前的p50)的比例, 0.5即慢了50%
+        self.min_delta = min_delta  # 耗时退化至少增加的秒数, 忽略很快的用例的抖动
+        self.min_runs = min_runs  # 窗口中至少有这么多次执行才判断耗时退化
+        self.pending = {}
+        self.regressions = []  # 最近一次保存时发现的耗时退化
+        self.run_id = None
+        self._durations = None
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.executescript(
+            'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, start_at REAL, duration REAL, total INTEGER, '
+            'pass_num INTEGER, fail_num INTEGER, error_num INTEGER, skipped_num INTEGER);'
+            'CREATE TABLE IF NOT EXISTS results (run_id INTEGER, test_id TEXT, status TEXT, duration REAL);'
+            'CREATE INDEX IF NOT EXISTS results_run ON results (run_id);'
+            'CREATE TABLE IF NOT EXISTS stats (test_id TEXT PRIMARY KEY, runs INTEGER, passes INTEGER, '
+            'statuses TEXT, durations TEXT, pass_rate REAL, flips INTEGER, p50 REAL, p95 REAL, last_run INTEGER);'
+            'CREATE INDEX IF NOT EXISTS stats_flips ON stats (flips);')
+        return conn
+
+    @property
+    def durations(self):
+        """用例id到最近执行耗时p50(秒)的映射, 为本次执行前的数据"""
+        if self._durations is None:
+            self._durations = {}
+            if os.path.exists(self.path):
+                with closing(self.connect()) as conn:
+                    self._durations = dict(conn.execute('SELECT test_id, p50 FROM stats WHERE p50 IS NOT NULL'))
+        return self._durations
+
+    def register(self, record):
+        if record.status in self.SKIPPED:
+            return
+        # 重试前失败的各次执行也计入状态序列, 重试后通过的用例因此记为一次翻转
+        statuses = 'F' * len(record.attempts) + ('P' if record.status in self.PASSED else 'F')
+        duration = record.duration.total_seconds() if record.duration else 0
+        self.pending[record.full_path] = (record.status, statuses, duration)
+
+    def run_complete(self, result):
+        self.save(result)
+
+    def save(self, result=None):
+        """追加本次执行并更新涉及的用例的滚动统计, 返回本次执行的id"""
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return None
+        if result is not None and getattr(result, 'start_at', None) and getattr(result, 'end_at', None):
+            stats = result.stats
+            run = (result.start_at.timestamp(), (result.end_at - result.start_at).total_seconds(), stats['total'],
+                   stats['pass_num'] + stats['xfail_num'], stats['fail_num'] + stats['xpass_num'],
+                   stats['error_num'], stats['skipped_num'])
+        else:
+            failed = sum(1 for _, statuses, _ in pending.values() if statuses[-1] == 'F')
+            run = (time.time(), sum(duration for _, _, duration in pending.values()), len(pending),
+                   len(pending) - failed, failed, 0, 0)
+        with closing(self.connect()) as conn, conn:
+            run_id = conn.execute('INSERT INTO runs (start_at, duration, total, pass_num, fail_num, error_num, '
+                                  'skipped_num) VALUES (?, ?, ?, ?, ?, ?, ?)', run).lastrowid
+            conn.executemany('INSERT INTO results VALUES (?, ?, ?, ?)',
+                             [(run_id, test_id, status, duration)
+                              for test_id, (status, _, duration) in pending.items()])
+            previous = self.load_stats(conn, list(pending))
+            self.regressions = []
+            rows = [self.update_stats(test_id, previous.get(test_id), status, statuses, duration, run_id)
+                    for test_id, (status, statuses, duration) in pending.items()]
+            conn.executemany('INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.execute('DELETE FROM results WHERE run_id <= ?', (run_id - self.keep_runs,))
+        self.run_id = run_id
+        return run_id
+
+    def load_stats(self, conn, test_ids, chunk=500):
+        stats = {}
+        for i in range(0, len(test_ids), chunk):
+            ids = test_ids[i:i + chunk]
+            query = 'SELECT test_id, runs, passes, statuses, durations, p50 FROM stats WHERE test_id IN (%s)'
+            for row in conn.execute(query % ','.join('?' * len(ids)), ids):
+                stats[row[0]] = row[1:]
+        return stats
+
+    def update_stats(self, test_id, previous, status, statuses, duration, run_id):
+        """由上次的统计和本次结果得到新的统计行, 只涉及窗口内的数据"""
+        runs, passes, window, durations, baseline = previous or (0, 0, '', '[]', None)
+        durations = json.loads(durations)
+        if (status == 'PASS' and baseline is not None and len(durations) >= self.min_runs
+                and duration > baseline * (1 + self.regression) and duration - baseline >= self.min_delta):
+            self.regressions.append(dict(test_id=test_id, duration=duration, baseline=baseline,
+                                         ratio=duration / baseline if baseline else None))
+        window = (window + statuses)[-self.window:]
+        durations = (durations + [round(duration, 4)])[-self.window:]
+        ordered = sorted(durations)
+        flips = sum(1 for a, b in zip(window, window[1:]) if a != b)
+        return (test_id, runs + len(statuses), passes + statuses.count('P'), window, json.dumps(durations),
+                window.count('P') / len(window), flips, quantile(ordered, 0.5), quantile(ordered, 0.95), run_id)
+
+    def trend(self, limit=30):
+        """最近limit次执行的汇总, 按时间顺序"""
+        if not os.path.exists(self.path):
+            return []
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT id, start_at, duration, total, pass_num, fail_num, error_num, skipped_num '
+                                'FROM runs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        keys = ('id', 'start_at', 'duration', 'total', 'pass_num', 'fail_num', 'error_num', 'skipped_num')
+        return [dict(zip(keys, row)) for row in reversed(rows)]
+
+    def flaky(self, limit=20, min_flips=2):
+        """最近窗口内状态翻转至少min_flips次的用例, 翻转多的在前"""
+        if not os.path.exists(self.path):
+            return []
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT test_id, flips, pass_rate, statuses, p50, p95 FROM stats WHERE flips >= ? '
+                                'ORDER BY flips DESC, pass_rate LIMIT ?', (min_flips, limit)).fetchall()
+        keys = ('test_id', 'flips', 'pass_rate', 'statuses', 'p50', 'p95')
+        return [dict(zip(keys, row)) for row in rows]
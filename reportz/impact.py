@@ -0,0 +1,128 @@
+"""按变更选择用例: 记录每个用例执行时调用过的源文件, 只执行受变更文件影响的用例"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import unittest
+
+from reportz.history import CACHE_DIR
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:  # 已删除的文件
+        return None
+
+
+class CoverageMap(object):
+    """用例id到其执行时调用过的源文件(相对root)的映射, 连同记录时各文件的sha1保存在JSON文件中.
+    用sys.settrace只跟踪函数调用, 模块级代码和用例中启动的其他线程不计入; 作为Result的监听者在执行后保存"""
+    def __init__(self, path=os.path.join(CACHE_DIR, 'coverage.json'), root='.'):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.tests = {}  # 本次执行记录的用例
+        self.fallback = False  # 最近一次select是否因映射过期而返回了全部用例
+        self._data = None
+        self._relpaths = {}  # co_filename -> root下的相对路径, 不需要记录的文件为None
+
+    def __getstate__(self):  # 传给子进程时只传配置, 记录随TestRecord.files回传
+        return dict(path=self.path, root=self.root)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def data(self):
+        """上次保存的映射: {'tests': {用例id: [文件]}, 'files': {文件: sha1}}"""
+        if self._data is None:
+            self._data = {'tests': {}, 'files': {}}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    self._data = json.load(f)
+        return self._data
+
+    def relpath(self, filename):
+        if filename not in self._relpaths:
+            path = os.path.abspath(filename)
+            relpath = os.path.relpath(path, self.root)
+            if (relpath.startswith(os.pardir) or not os.path.isfile(path) or path.startswith(PACKAGE_DIR)
+                    or 'site-packages' in relpath.split(os.sep)):
+                relpath = None
+            self._relpaths[filename] = relpath and relpath.replace(os.sep, '/')
+        return self._relpaths[filename]
+
+    def start_test(self, test):
+        files = set()
+        previous = sys.gettrace()  # 如coverage.py, 继续调用
+
+        def trace(frame, event, arg):
+            files.add(frame.f_code.co_filename)
+            return previous(frame, event, arg) if previous is not None else None
+        test._coverage_state = (threading.get_ident(), previous, files)
+        sys.settrace(trace)
+
+    def stop_test(self, test):
+        """结束跟踪, 返回用例调用过的文件(已排序), 已结束过的用例返回None"""
+        state = test.__dict__.pop('_coverage_state', None)
+        if state is None:
+            return None
+        thread, previous, files = state
+        if thread == threading.get_ident():  # 超时的用例在主线程登记, 被放弃的线程不再恢复
+            sys.settrace(previous)
+        return sorted({path for path in map(self.relpath, list(files)) if path})
+
+    def register(self, record):
+        if record.files:
+            self.tests[record.full_path] = record.files
+
+    def run_complete(self, result):
+        self.save()
+
+    def save(self):
+        if not self.tests:
+            return
+        data = self.data
+        data['tests'].update(self.tests)
+        for path in {path for files in self.tests.values() for path in files}:
+            data['files'][path] = file_digest(os.path.join(self.root, path))
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=0)
+        self.tests = {}
+
+    def affected(self, test_ids, changed):
+        """受changed中的文件影响的用例id, 映射中没有的用例也会选中;
+        映射为空或记录的文件在changed之外有改动(映射已过期)时返回None"""
+        data = self.data
+        if not data['tests']:
+            return None
+        changed = {os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/') for path in changed}
+        for path, digest in data['files'].items():
+            if path not in changed and file_digest(os.path.join(self.root, path)) != digest:
+                return None
+        return {test_id for test_id in test_ids
+                if test_id not in data['tests'] or changed.intersection(data['tests'][test_id])}
+
+    def select(self, suite, changed):
+        """只保留受影响的用例, 映射过期时返回原suite并设置fallback"""
+        tests = list(flatten(suite))
+        affected = self.affected([test.id() for test in tests], changed)
+        self.fallback = affected is None
+        if affected is None:
+            return suite
+        return unittest.TestSuite(test for test in tests if test.id() in affected)
+
+
+def flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from flatten(test)
+        else:
+            yield test
@@ -0,0 +1,261 @@
+"""执行过程中的实时进度: Result上的事件总线, 以及基于它的自动刷新的进度文件和本地HTTP/SSE服务
+
+    events = EventBus()
+    events.subscribe(LiveReport('progress.html'))
+    server = LiveServer(port=8765)
+    events.subscribe(server)
+    HTMLRunner('report.html', events=events).run(suite)
+"""
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PASSED = ('PASS', 'SKIPPED', 'XFAIL')
+STATS_KEYS = ('total', 'pass_num', 'fail_num', 'error_num', 'skipped_num', 'xfail_num', 'xpass_num',
+              'timeout_num', 'rerun_num')
+
+
+def event_data(event, data):
+    """在分发线程中把事件数据转为可JSON序列化的dict, 执行线程中只入队原始对象"""
+    if event in ('register', 'update'):
+        item = {
+            'id': data.full_path,
+            'name': data.full_name,
+            'class': data.test_class,
+            'status': data.status,
+            'duration': data.duration.total_seconds() if data.duration else 0,
+        }
+        if data.status not in PASSED:
+            item['exec_info'] = data.exec_info
+        return item
+    if event == 'class_complete':
+        item = {key: data[key] for key in STATS_KEYS}
+        item['name'] = data['name']
+        item['duration'] = data['duration'].total_seconds()
+        return item
+    return data
+
+
+class EventBus(object):
+    """Result的事件总线: 执行线程中emit只把事件放入队列, 由单独的线程按批(最多batch_size个或等待interval秒)
+    分发给订阅者, 订阅者处理慢不会阻塞用例执行. 事件有run_start, start_test, register, update, class_complete
+    和run_complete, 同时作为Result的监听者接收class_complete和run_complete, run_complete后分发完剩余事件并停止"""
+    def __init__(self, batch_size=500, interval=0.2):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.subscribers = []
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def __getstate__(self):  # 子进程中的用例由父进程收到记录时发出事件
+        return dict(batch_size=self.batch_size, interval=self.interval)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def subscribe(self, subscriber):
+        """subscriber实现handle(events), events为[(事件, dict)]"""
+        self.subscribers.append(subscriber)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.dispatch, name='reportz-events', daemon=True)
+            self.thread.start()
+
+    def emit(self, event, data):
+        if self.subscribers:
+            self.queue.put((event, data))
+
+    def dispatch(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            events = [(event, event_data(event, data)) for event, data in filter(None, batch)]
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.handle(events)
+                except Exception:
+                    traceback.print_exc()
+            if batch[-1] is None:
+                return
+
+    def close(self):
+        """分发完队列中的事件后停止分发线程"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def class_complete(self, test_class):
+        self.emit('class_complete', test_class)
+
+    def run_complete(self, result):
+        stats = {key: result.stats[key] for key in STATS_KEYS}
+        stats.update(run_num=result.testsRun, time=time.time())
+        self.emit('run_complete', stats)
+        self.close()
+
+
+class LiveState(object):
+    """根据事件累计的实时进度: 各状态数量, 正在执行的用例, 失败/出错的用例和按已用时间估算的剩余时间"""
+    def __init__(self, title='Test Report', max_failures=200):
+        self.title = title
+        self.max_failures = max_failures
+        self.total = 0
+        self.start_at = None
+        self.end_at = None
+        self.statuses = {}  # 用例id -> 状态, 同一用例的update覆盖之前的状态
+        self.running = {}  # 用例id -> 开始时间
+        self.failures = {}  # 用例id -> 事件数据, 按失败顺序
+        self.lock = threading.Lock()
+
+    def handle(self, events):
+        with self.lock:
+            for event, data in events:
+                if event == 'run_start':
+                    self.total, self.start_at = data['total'], data['time']
+                elif event == 'start_test':
+                    self.running[data['id']] = data['time']
+                elif event in ('register', 'update'):
+                    self.running.pop(data['id'], None)
+                    self.statuses[data['id']] = data['status']
+                    if data['status'] in PASSED:
+                        self.failures.pop(data['id'], None)
+                    else:
+                        self.failures[data['id']] = data
+                elif event == 'run_complete':
+                    self.end_at = data['time']
+                    self.running.clear()
+
+    def snapshot(self):
+        with self.lock:
+            done = len(self.statuses)
+            now = self.end_at or time.time()
+            elapsed = now - self.start_at if self.start_at else 0
+            remaining = max(self.total - done, 0)
+            return {
+                'title': self.title,
+                'total': max(self.total, done),
+                'done': done,
+                'counts': dict(Counter(self.statuses.values())),
+                'running': sorted(self.running, key=self.running.get),
+                'failure_num': len(self.failures),
+                'failures': list(self.failures.values())[-self.max_failures:],
+                'elapsed': elapsed,
+                'eta': elapsed / done * remaining if done and not self.end_at else None,
+                'finished': self.end_at is not None,
+            }
+
+    def render(self, **kwargs):
+        from reportz import template_env
+        return template_env().get_template('live.html').render(self.snapshot(), **kwargs)
+
+
+class LiveReport(LiveState):
+    """执行过程中每隔interval秒重写一次的进度文件, 页面自动刷新, 执行结束后停止刷新"""
+    def __init__(self, path, title='Test Report', interval=2, max_failures=200):
+        super().__init__(title, max_failures)
+        self.path = path
+        self.interval = interval
+        self.written_at = 0
+
+    def handle(self, events):
+        super().handle(events)
+        if self.end_at is not None or time.monotonic() - self.written_at >= self.interval:
+            self.write()
+
+    def write(self):
+        content = self.render(refresh=None if self.end_at else max(int(self.interval), 1))
+        temp = '%s.tmp' % self.path
+        with open(temp, 'w') as f:
+            f.write(content)
+        os.replace(temp, self.path)  # 浏览器不会读到写了一半的文件
+        self.written_at = time.monotonic()
+
+
+class LiveServer(LiveState):
+    """本地HTTP服务: /为实时进度页面, /state为JSON快照, /events为SSE事件流(每批事件一条消息)"""
+    def __init__(self, host='127.0.0.1', port=0, title='Test Report', max_failures=200):
+        super().__init__(title, max_failures)
+        self.clients = []  # 每个SSE连接一个队列
+        self.httpd = ThreadingHTTPServer((host, port), LiveHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.live = self
+        threading.Thread(target=self.httpd.serve_forever, name='reportz-live', daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%s/' % (host, port)
+
+    def handle(self, events):
+        super().handle(events)
+        message = json.dumps(events, ensure_ascii=False, default=str)
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.put(message)
+
+    def connect(self):
+        client = queue.SimpleQueue()
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def disconnect(self, client):
+        with self.lock:
+            self.clients.remove(client)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class LiveHandler(BaseHTTPRequestHandler):
+    keepalive = 15  # 没有事件时发送注释行的间隔(秒), 用于发现已断开的连接
+
+    def do_GET(self):
+        live = self.server.live
+        if self.path == '/events':
+            return self.stream(live)
+        if self.path == '/state':
+            body, content_type = json.dumps(live.snapshot(), default=str), 'application/json'
+        elif self.path == '/':
+            body, content_type = live.render(server=True), 'text/html; charset=utf-8'
+        else:
+            return self.send_error(404)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, live):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        client = live.connect()
+        try:
+            while True:
+                try:
+                    self.wfile.write(('data: %s\n\n' % client.get(timeout=self.keepalive)).encode('utf-8'))
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            live.disconnect(client)
+
+    def log_message(self, format, *args):  # 不输出访问日志
+        pass
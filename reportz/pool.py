@@ -0,0 +1,201 @@
+"""常驻的预热进程: 导入一次reportz和用例模块, 之后每次执行都从它fork, 省去启动和导入的时间
+
+    python -m reportz serve tests            # 在另一个终端中保持运行
+    python -m reportz run tests --pool -o report.html
+"""
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+import unittest
+
+from reportz.history import CACHE_DIR
+
+DEFAULT_ADDRESS = os.path.join(CACHE_DIR, 'pool.sock')
+LISTEN_FD = 'REPORTZ_POOL_FD'  # restart时传给新进程的监听socket
+HEADER = struct.Struct('!Q')
+
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    return data
+
+
+def project_files(root):
+    """已导入的模块中位于root下(不含site-packages)的文件及其mtime"""
+    files = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if not path:
+            continue
+        path = os.path.abspath(path)
+        if path.startswith(root + os.sep) and 'site-packages' not in path.split(os.sep):
+            try:
+                files[path] = os.path.getmtime(path)
+            except OSError:
+                continue
+    return files
+
+
+class WarmPool(object):
+    """在unix socket上等待`reportz run --pool`的请求, 每个请求fork一个子进程执行该命令.
+    子进程继承已导入的模块, 客户端的标准输入/输出/错误随请求传入, 执行结束后回传退出码;
+    已导入的项目文件有改动时回复stale并重新启动自身, 该次请求由客户端在本地执行"""
+    def __init__(self, start_dir='.', pattern='test*.py', address=DEFAULT_ADDRESS):
+        self.start_dir = start_dir
+        self.pattern = pattern
+        self.address = address
+        self.root = os.getcwd()
+        self.files = {}
+
+    def preload(self):
+        import reportz.__main__  # noqa: F401
+        unittest.defaultTestLoader.discover(self.start_dir, pattern=self.pattern)
+        self.files = project_files(self.root)
+
+    def stale(self):
+        for path, mtime in self.files.items():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def listen(self):
+        """先监听再预加载, 预加载期间的连接在backlog中等待; restart后沿用原来的socket"""
+        fd = os.environ.pop(LISTEN_FD, None)
+        if fd is not None:
+            return socket.socket(fileno=int(fd))
+        directory = os.path.dirname(self.address)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.address)
+        server.listen()
+        return server
+
+    def serve_forever(self):
+        start = time.monotonic()
+        server = self.listen()
+        try:
+            self.preload()
+            print('reportz pool ready at %s, preloaded %d files in %.2fs' % (
+                self.address, len(self.files), time.monotonic() - start), file=sys.stderr)
+            while True:
+                conn, _ = server.accept()
+                self.reap()
+                if self.stale():
+                    conn.sendall(b'stale\n')
+                    conn.close()
+                    self.restart(server)
+                self.handle(server, conn)
+        finally:
+            server.close()
+            if os.path.exists(self.address):
+                os.remove(self.address)
+
+    def restart(self, server):
+        print('reportz pool: project files changed, restarting', file=sys.stderr)
+        server.set_inheritable(True)
+        os.environ[LISTEN_FD] = str(server.fileno())
+        os.execv(sys.executable, [sys.executable, '-m', 'reportz'] + sys.argv[1:])
+
+    def reap(self):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+
+    def handle(self, server, conn):
+        try:
+            header, fds, _, _ = socket.recv_fds(conn, HEADER.size, 3)
+            request = json.loads(recv_exactly(conn, HEADER.unpack(header)[0]))
+        except (OSError, EOFError, ValueError, struct.error):
+            traceback.print_exc()
+            conn.close()
+            return
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            code = 1
+            try:
+                conn.sendall(('%s\n' % json.dumps({'pid': os.getpid()})).encode())
+                code = self.execute(request, fds)
+            finally:
+                try:
+                    conn.sendall(('%s\n' % json.dumps({'exit': code})).encode())
+                finally:
+                    os._exit(0)
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+    def execute(self, request, fds):
+        """在fork出的子进程中执行命令, 返回退出码"""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        from reportz.__main__ import main
+        try:
+            return main(request['argv'])
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+
+def run_in_pool(argv, address=DEFAULT_ADDRESS):
+    """把命令交给常驻进程执行并返回退出码, 常驻进程不存在, 不可用或已过期时返回None"""
+    if not hasattr(socket, 'send_fds') or not os.path.exists(address):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(address)
+        request = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        socket.send_fds(conn, [HEADER.pack(len(request))], [0, 1, 2])
+        conn.sendall(request)
+        lines = conn.makefile('r')
+        pid = None
+        try:
+            for line in lines:
+                if line.strip() == 'stale':
+                    return None
+                message = json.loads(line)
+                if 'pid' in message:
+                    pid = message['pid']
+                elif 'exit' in message:
+                    return message['exit']
+        except KeyboardInterrupt:
+            if pid is not None:
+                os.kill(pid, signal.SIGINT)
+            raise
+        return None if pid is None else 1  # 子进程异常退出
+    except OSError:
+        return None
+    finally:
+        conn.close()
@@ -0,0 +1,147 @@
+"""用例级的性能分析: CPU时间, cProfile, tracemalloc内存分配和fixture耗时"""
+import cProfile
+import marshal
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from reportz.history import CACHE_DIR
+
+
+class Instrumentation(object):
+    """可选的性能分析, 挂在Result.startTest/register上, 同时作为Result的监听者在类执行完成后导出按类的.pstats
+
+    cpu: 记录用例执行线程的CPU时间(time.thread_time, 线程池中不受其他线程影响)
+    memory: 用tracemalloc记录用例执行期间的内存峰值和净分配(字节), 并行执行时包含同时执行的其他用例
+    profile: 'test'或'class', 按用例或按类导出cProfile结果到pstats_dir
+    """
+    def __init__(self, cpu=True, memory=False, profile=None, pstats_dir=os.path.join(CACHE_DIR, 'pstats')):
+        if profile not in (None, 'test', 'class'):
+            raise ValueError("profile should be None, 'test' or 'class'")
+        self.cpu = cpu
+        self.memory = memory
+        self.profile = profile
+        self.pstats_dir = pstats_dir
+        self.fixtures = defaultdict(float)  # (类型, 名称) -> 累计耗时(秒)
+        self.pstats = {}  # 类名 -> 按类导出的.pstats文件
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.tracing = False  # 是否由本对象启动了tracemalloc, 执行结束时停止
+
+    def __getstate__(self):  # 传给子进程时只传配置
+        return dict(cpu=self.cpu, memory=self.memory, profile=self.profile, pstats_dir=self.pstats_dir)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def start_test(self, test):
+        state = {}
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            tracemalloc.reset_peak()
+            state['memory'] = tracemalloc.get_traced_memory()[0]
+        if self.profile:
+            state['profiler'] = self.profiler(test)
+            state['profiler'].enable()
+        if self.cpu:
+            state['cpu'] = time.thread_time()
+        test._instrument_state = state
+
+    def stop_test(self, test):
+        """结束用例的统计, 返回指标dict, 已结束过的用例返回None"""
+        state = test.__dict__.pop('_instrument_state', None)
+        if state is None:
+            return None
+        metrics = {}
+        if 'cpu' in state:
+            metrics['cpu'] = time.thread_time() - state['cpu']
+        if 'profiler' in state:
+            state['profiler'].disable()
+            if self.profile == 'test':
+                metrics['pstats'] = self.dump(state['profiler'], test.id())
+        if 'memory' in state:
+            current, peak = tracemalloc.get_traced_memory()
+            metrics['memory_peak'] = max(peak - state['memory'], 0)
+            metrics['memory_net'] = current - state['memory']
+        return metrics
+
+    def profiler(self, test):
+        from reportz import record_class_name
+        if self.profile == 'test':
+            return cProfile.Profile()
+        with self.lock:
+            return self.profiles.setdefault(record_class_name(test.__class__), cProfile.Profile())
+
+    def path(self, name):
+        os.makedirs(self.pstats_dir, exist_ok=True)
+        return os.path.join(self.pstats_dir, '%s.pstats' % re.sub(r'[^\w.-]', '_', name))
+
+    def dump(self, profiler, name):
+        path = self.path(name)
+        profiler.dump_stats(path)
+        return path
+
+    def worker_state(self):
+        """子进程执行完成时回传给父进程: fixture耗时和按类的cProfile统计(marshal格式, 同.pstats文件内容)"""
+        profiles = {}
+        for name, profiler in self.profiles.items():
+            profiler.create_stats()
+            profiles[name] = profiler.stats
+        return dict(fixtures=dict(self.fixtures), profiles=profiles)
+
+    def merge(self, state):
+        """合并子进程回传的worker_state, 同一个类(如超时重启后在新进程中继续执行)的统计累加到已有的.pstats"""
+        for (kind, name), seconds in state['fixtures'].items():
+            self.add_fixture(kind, name, seconds)
+        for name, stats in state['profiles'].items():
+            path = self.path(name)
+            merged = pstats.Stats(path) if name in self.pstats else None
+            with open(path, 'wb') as f:
+                marshal.dump(stats, f)
+            if merged is not None:
+                merged.add(path)
+                merged.dump_stats(path)
+            self.pstats[name] = path
+
+    def add_fixture(self, kind, name, seconds):
+        with self.lock:
+            self.fixtures[(kind, name)] += seconds
+
+    def slowest_fixtures(self, num=None):
+        """按累计耗时排序的fixture: [(类型, 名称, 秒)]"""
+        items = sorted(((kind, name, seconds) for (kind, name), seconds in self.fixtures.items()),
+                       key=lambda item: item[2], reverse=True)
+        return items[:num] if num else items
+
+    def class_complete(self, test_class):
+        with self.lock:
+            profiler = self.profiles.pop(test_class['name'], None)
+        if profiler is not None:
+            self.pstats[test_class['name']] = self.dump(profiler, test_class['name'])
+
+    def run_complete(self, result):
+        for name in list(self.profiles):
+            self.class_complete({'name': name})
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+
+def run_fixture(result, kind, name, func, *args):
+    """执行fixture(如suite._handleClassSetUp), result开启了性能分析时按(kind, name)累计耗时, name可以是类"""
+    from reportz import record_class_name
+    instrument = getattr(result, 'instrument', None)
+    if instrument is None or name is None:
+        return func(*args)
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        instrument.add_fixture(kind, name if isinstance(name, str) else record_class_name(name),
+                               time.perf_counter() - start)
@@ -1,7 +1,12 @@
 import os
 import sys
+import re
 sys.path.append('/Users/apple/Documents/Projects/Self/Pythonz/reportz')
+import time
+import asyncio
 import unittest
+from datetime import timedelta
+import reportz
 from reportz import Runner, group_suites_by_class, flatten_suite, HTMLRunner
 from reportz import Result
 
@@ -44,15 +49,69 @@ def test_run_suite_in_thread_poll():
     runner.run_suite_in_thread_poll(suite, result)
     print(result)
 
+def test_run_suite_in_thread_poll_with_result():
+    suite = unittest.defaultTestLoader.discover(testpath)
+    result = Result()
+    runner.run_suite_in_thread_poll(suite, result, thread_num=4)
+    assert 16 == len(result.result)
+    assert 'success with 1\n' == result.result['test_demo1.TestDemo1.test_success_1_1'].output
+    assert 5 == len(result.success)
+    assert all(test_id in result.result for test_id in result.success)
+    assert sys.stdout is not reportz.stdout_redirector
+
+
+def test_run_suite_in_process_pool():
+    suite = unittest.defaultTestLoader.discover(testpath)
+    result = Result()
+    runner.run_suite_in_process_pool(suite, result, workers=2)
+    assert 16 == len(result.result)
+    assert all(isinstance(item, reportz.TestRecord) for item in result.result.values())
+    assert 5 == len(result.success)
+    assert all(test_id in result.result for test_id in result.success)
+
+
+
+def test_run_suite_in_process_pool_with_test_result():
+    suite = unittest.defaultTestLoader.discover(testpath)
+    result = unittest.result.TestResult()
+    runner.run_suite_in_process_pool(suite, result, workers=2)
+    assert 11 == result.testsRun  # setUpClass出错的类中的用例未执行
+    assert (12, 2, 2) == (len(result.errors), len(result.failures), len(result.skipped))
+
 def test_group_suites_by_class():
     suite = unittest.defaultTestLoader.discover(testpath)
     suite_list = group_suites_by_class(suite)
     assert 3 == len(suite_list)
 
 
+class HangingTests(unittest.TestCase):
+    __test__ = False  # 只由下面的用例驱动执行
+
+    @reportz.timeout(0.3)
+    def test_hang(self):
+        print('before hang')
+        for _ in range(30):  # 分段sleep, 超时后抛入的TimeoutError能及时结束线程
+            time.sleep(0.1)
+
+    def test_quick(self):
+        print('quick')
+
+
 def test_timeout():
-    suite = unittest.defaultTestLoader.discover(testpath)
-    runner.run_with_timeout(suite, result, 3)
+    hang_id, quick_id = HangingTests('test_hang').id(), HangingTests('test_quick').id()
+    for kwargs in ({}, {'thread_num': 2}, {'workers': 1}):
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(HangingTests)
+        t0 = time.monotonic()
+        result = Runner().run(suite, reruns=2, **kwargs)
+        time.sleep(0.2)  # 被放弃的线程收到TimeoutError后迟到的addError应被忽略
+        assert time.monotonic() - t0 < 2.5
+        assert 'TIMEOUT' == result.result[hang_id].status
+        assert 'PASS' == result.result[quick_id].status
+        assert 1 == result.stats['timeout_num'] == len(result.timeouts) == len(result.errors)
+        assert 2 == result.testsRun
+        assert not result.wasSuccessful()
+        assert 'before hang\n' == result.result[hang_id].output
+
     
 def test_with_default_template():
     suite = unittest.defaultTestLoader.discover(testpath)
@@ -74,5 +133,734 @@ def test_with_pytest_html_template():
                description="测试报告描述", tester='Hzc',template='pytest_html').run(suite)
 
 
+def test_with_stream_template(tmp_path):
+    suite = unittest.defaultTestLoader.discover(testpath)
+    output = str(tmp_path / 'report_stream.html')
+    result = HTMLRunner(output=output, title="测试报告", template='stream', stream=True).run(suite)
+    with open(output) as f:
+        content = f.read()
+    assert not result.result
+    assert content.count('<td colspan="2">') == 3
+    assert '总数: 16' in content
+
+
+def test_record_code_is_lazy():
+    suite = unittest.defaultTestLoader.discover(testpath)
+    result = Result()
+    runner.run_suite(suite, result)
+    record = result.result['test_demo1.TestDemo1.test_success_1_1']
+    assert record._code is None
+    assert record.code.startswith('    @ddt.data(*data)\n    def test_success(self, value):')
+
+
+def test_result_stats():
+    suite = unittest.defaultTestLoader.discover(testpath)
+    result = Result()
+    runner.run_suite(suite, result)
+    assert dict(total=16, pass_num=5, fail_num=2, error_num=7, skipped_num=2) == {
+        key: result.stats[key] for key in ('total', 'pass_num', 'fail_num', 'error_num', 'skipped_num')}
+    test_classes = result.sortByClass()
+    assert 16 == sum(test_class['total'] for test_class in test_classes)
+    assert all(test_class['duration'] == sum((test.duration for test in test_class['test_cases'] if test.duration),
+                                             timedelta()) for test_class in test_classes)
+
+
+def test_with_user_template_dir(tmp_path):
+    (tmp_path / 'mine.html').write_text(
+        "{% for test_class in test_classes %}{% for test in test_class.test_cases %}"
+        "{{test.status|status_class('ok', 'ko', 'err', 'skip')}} {% endfor %}{% endfor %}{{duration|duration}}")
+    suite = unittest.defaultTestLoader.discover(testpath)
+    output = str(tmp_path / 'report_mine.html')
+    HTMLRunner(output=output, template='mine', template_dirs=[str(tmp_path)]).run(suite)
+    with open(output) as f:
+        content = f.read()
+    assert 5 == content.count('ok ')
+    assert content.endswith('s')
+    assert reportz.template_env(str(tmp_path)) is reportz.template_env(str(tmp_path))
+
+
+def test_export_jsonl_and_junit(tmp_path):
+    import json
+    from xml.etree import ElementTree
+    from reportz import JsonLinesExporter, JUnitExporter, TestRecord
+    suite = unittest.defaultTestLoader.discover(testpath)
+    jsonl, junit = str(tmp_path / 'result.jsonl'), str(tmp_path / 'junit.xml')
+    HTMLRunner(output=str(tmp_path / 'report.html'),
+               listeners=[JsonLinesExporter(jsonl), JUnitExporter(junit)]).run(suite)
+    with open(jsonl) as f:
+        lines = [json.loads(line) for line in f]
+    records = {line['full_path']: TestRecord.from_dict(line) for line in lines if line['type'] == 'test'}
+    assert 16 == len(records)
+    assert 'run' == lines[-1]['type']
+    testsuites = ElementTree.parse(junit).getroot()
+    assert 16 == len(testsuites.findall('testsuite/testcase'))
+    assert 2 == len(testsuites.findall('testsuite/testcase/failure'))
+
+
+def test_shard_and_merge(tmp_path):
+    from reportz import shard_suite, load_results
+    from reportz.__main__ import main
+    suite = unittest.defaultTestLoader.discover(testpath)
+    shards = [shard_suite(suite, index, 2) for index in (1, 2)]
+    assert 16 == sum(shard.countTestCases() for shard in shards)
+    assert not {test.id() for test in shards[0]} & {test.id() for test in shards[1]}
+
+    paths = [str(tmp_path / ('shard%s.jsonl' % index)) for index in (1, 2)]
+    for index, path in enumerate(paths, 1):
+        main(['run', testpath, '--shard', '%s/2' % index, '--jsonl', path])
+    result = load_results(paths)
+    assert 16 == result.stats['total']
+    assert 5 == result.stats['pass_num']
+    main(['merge'] + paths + ['-o', str(tmp_path / 'report.html')])
+    assert (tmp_path / 'report.html').exists()
+
+
+def test_duration_history(tmp_path):
+    from reportz import DurationHistory, partition_suites, duration_weight
+    history = DurationHistory(str(tmp_path / 'durations.db'))
+    suite = unittest.defaultTestLoader.discover(testpath)
+    output = str(tmp_path / 'report.html')
+    HTMLRunner(output=output, history=history, slowest=3).run(suite)
+    durations = DurationHistory(str(tmp_path / 'durations.db')).durations
+    assert 'test_demo1.TestDemo1.test_success_1_1' in durations
+    with open(output) as f:
+        assert '最慢的3个用例' in f.read()
+
+    suite_list = group_suites_by_class(unittest.defaultTestLoader.discover(testpath))
+    durations = {test.id(): 0.1 for class_suite in suite_list for test in class_suite}
+    durations.update({test.id(): 10 for test in suite_list[0]})
+    shards = partition_suites(suite_list, 2, weight=duration_weight(durations))
+    assert [suite_list[0]] == shards[0]
+
+
+class FlakyTests(unittest.TestCase):
+    __test__ = False
+    calls = 0
+
+    def test_broken(self):
+        self.fail('always')
+
+    def test_flaky(self):
+        FlakyTests.calls += 1
+        self.assertGreater(FlakyTests.calls, 1)
+
+
+def test_reruns_and_failed_first(tmp_path):
+    from reportz import LastFailed, order_failed_first
+    path = str(tmp_path / 'lastfailed.json')
+    broken_id, flaky_id = FlakyTests('test_broken').id(), FlakyTests('test_flaky').id()
+    for kwargs in ({}, {'thread_num': 2}, {'workers': 1}):
+        FlakyTests.calls = 0
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(FlakyTests)
+        result = Runner().run(suite, reruns=2, last_failed=LastFailed(path), **kwargs)
+        assert 'PASS' == result.result[flaky_id].status and 1 == len(result.result[flaky_id].attempts)
+        assert 'FAIL' == result.result[broken_id].status and 2 == len(result.result[broken_id].attempts)
+        assert 3 == result.stats['rerun_num']
+        assert 1 == len(result.failures)
+        assert 2 == result.testsRun
+    assert [broken_id] == LastFailed(path).ids
+
+    suite = unittest.defaultTestLoader.discover(testpath)
+    last_id = list(flatten_suite(suite))[-1].id()
+    ordered = list(flatten_suite(order_failed_first(suite, {last_id})))
+    assert last_id == ordered[0].id()
+    assert 16 == len(ordered)
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(FlakyTests)
+    assert [broken_id] == [test.id() for test in reportz.Loader().load_last_fails(suite, path)]
+
+
+def test_collection_index(tmp_path):
+    from reportz import TestIndex, Loader
+    (tmp_path / 'test_indexed.py').write_text(
+        "import unittest\n"
+        "import reportz\n\n"
+        "@reportz.tag('api')\n"
+        "class TestIndexed(unittest.TestCase):\n"
+        "    @reportz.tag('smoke')\n"
+        "    @reportz.level(1)\n"
+        "    def test_login(self):\n"
+        "        pass\n\n"
+        "    @reportz.tag('slow')\n"
+        "    def test_export(self):\n"
+        "        pass\n\n"
+        "    def test_logout(self):\n"
+        "        pass\n")
+    cache = str(tmp_path / 'index.json')
+    index = TestIndex(str(tmp_path), cache=cache)
+    assert 1 == index.imported and 3 == len(index.tests)
+    index = TestIndex(str(tmp_path), cache=cache)
+    assert 0 == index.imported and 3 == len(index.tests)
+
+    ids = {name: 'test_indexed.TestIndexed.%s' % name for name in ('test_login', 'test_export', 'test_logout')}
+    assert [ids['test_login']] == index.select(tags='smoke')
+    assert [ids['test_logout']] == index.select(tags='api and not (smoke or slow)')
+    assert [ids['test_export'], ids['test_logout']] == index.select(tags='api and not smoke')
+    assert [ids['test_login']] == index.select(level='<2')
+    assert [ids['test_logout']] == index.select(tags='not slow', level='2')
+    assert [ids['test_export']] == index.select(names=['test_export'])
+
+    suite = index.suite(index.select(tags='api and not smoke'))
+    assert [ids['test_export'], ids['test_logout']] == [test.id() for test in flatten_suite(suite)]
+    result = Runner().run(suite)
+    assert ['api', 'slow'] == sorted(result.result[ids['test_export']].tags)
+
+    os.utime(str(tmp_path / 'test_indexed.py'), (0, 0))
+    assert 1 == TestIndex(str(tmp_path), cache=cache).imported
+
+
+def test_output_spills_to_log(tmp_path, capsys):
+    class ChattyTests(unittest.TestCase):
+        def test_chatty(self):
+            for i in range(1000):
+                print('line %04d' % i)
+
+    output = str(tmp_path / 'report.html')
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(ChattyTests)
+    result = HTMLRunner(output=output, output_limit=1000, echo=False).run(suite)
+    record = next(iter(result.result.values()))
+    assert record.output.startswith('line 0000\n') and record.output.endswith('line 0999\n')
+    assert len(record.output) < 1000 + 300  # 开头和结尾各500字符, 加上省略说明
+    with open(record.log) as f:
+        assert 10000 == len(f.read())
+    assert os.path.dirname(record.log) == str(tmp_path / 'report_logs')
+    with open(output) as f:
+        assert 'href="report_logs/' in f.read()
+    assert 'line 0500' not in capsys.readouterr().out
+
+
+def test_instrumentation(tmp_path):
+    import pstats
+    from reportz import Instrumentation
+
+    class ProfiledTests(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            time.sleep(0.05)
+
+        def test_allocate(self):
+            self.data = [bytearray(1000) for _ in range(1000)]
+
+        def test_spin(self):
+            sum(range(200000))
+
+    instrument = Instrumentation(memory=True, profile='test', pstats_dir=str(tmp_path / 'pstats'))
+    output = str(tmp_path / 'report.html')
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(ProfiledTests)
+    result = HTMLRunner(output=output, instrument=instrument, echo=False).run(suite)
+    records = {record.name: record for record in result.result.values()}
+    assert records['test_allocate'].metrics['memory_peak'] > 1000 * 1000
+    assert records['test_spin'].metrics['cpu'] > 0
+    assert 'sum' in str(pstats.Stats(records['test_spin'].metrics['pstats']).stats)
+    kind, name, seconds = instrument.slowest_fixtures()[0]
+    assert 'setUpClass' == kind and name.endswith('ProfiledTests') and 0.05 <= seconds < 0.5
+    with open(output) as f:
+        assert 'Fixture耗时' in f.read()
+
+
+def test_paged_report(tmp_path):
+    import re
+    import json
+    import gzip
+    import base64
+    suite = unittest.defaultTestLoader.discover(testpath)
+    output = str(tmp_path / 'report_paged.html')
+    result = HTMLRunner(output=output, title="测试报告", paged=True).run(suite)
+    with open(output) as f:
+        content = f.read()
+    assert not result.result
+    assert '总数: 16' in content
+    chunks = sorted(os.listdir(str(tmp_path / 'report_paged_data')))
+    assert chunks == ['0.js', '1.js', '2.js']
+    with open(str(tmp_path / 'report_paged_data' / '0.js')) as f:
+        index, payload = re.match(r'reportzChunk\((\d+), "(.*)"\);', f.read()).groups()
+    tests = json.loads(gzip.decompress(base64.b64decode(payload)))
+    assert index == '0' and tests[0]['status'] and tests[0]['name']
+    assert '"chunk": "report_paged_data/0.js"' in content
+
+
+def test_coverage_map_selects_affected_tests(tmp_path):
+    from reportz import CoverageMap
+    (tmp_path / 'impact_add.py').write_text('def add(a, b):\n    return a + b\n')
+    (tmp_path / 'impact_sub.py').write_text('def sub(a, b):\n    return a - b\n')
+    (tmp_path / 'test_impact.py').write_text(
+        'import unittest\nimport impact_add, impact_sub\n\n'
+        'class TestAdd(unittest.TestCase):\n    def test_add(self):\n        self.assertEqual(impact_add.add(1, 2), 3)\n\n'
+        'class TestSub(unittest.TestCase):\n    def test_sub(self):\n        self.assertEqual(impact_sub.sub(3, 2), 1)\n')
+    path = str(tmp_path / 'coverage.json')
+    discover = lambda: unittest.TestLoader().discover(str(tmp_path), pattern='test_impact.py')
+    result = Runner().run(discover(), coverage=CoverageMap(path, root=str(tmp_path)))
+    assert result.result['test_impact.TestAdd.test_add'].files == ['impact_add.py', 'test_impact.py']
+
+    coverage = CoverageMap(path, root=str(tmp_path))
+    result = Runner().run(discover(), coverage=coverage, changed=[str(tmp_path / 'impact_sub.py')])
+    assert list(result.result) == ['test_impact.TestSub.test_sub'] and not coverage.fallback
+
+    (tmp_path / 'impact_add.py').write_text('def add(a, b):\n    return b + a\n')  # 未列入changed的改动
+    coverage = CoverageMap(path, root=str(tmp_path))
+    result = Runner().run(discover(), coverage=coverage, changed=[])
+    assert len(result.result) == 2 and coverage.fallback
+
+
+def test_live_events(tmp_path):
+    import json
+    from urllib.request import urlopen
+    from reportz import EventBus, LiveReport, LiveServer
+
+    class Recorder(object):
+        def __init__(self):
+            self.events = []
+
+        def handle(self, events):
+            self.events.extend(events)
+
+    suite = unittest.defaultTestLoader.discover(testpath)
+    events, recorder = EventBus(), Recorder()
+    report, server = LiveReport(str(tmp_path / 'progress.html')), LiveServer()
+    for subscriber in (recorder, report, server):
+        events.subscribe(subscriber)
+    output = str(tmp_path / 'report.html')
+    result = HTMLRunner(output=output, events=events).run(suite, thread_num=2)
+
+    names = [event for event, _ in recorder.events]
+    assert names[0] == 'run_start' and names[-1] == 'run_complete'
+    assert names.count('register') == 16 and names.count('class_complete') == 3
+    assert len({data['id'] for event, data in recorder.events if event == 'start_test'}) == result.testsRun
+    with open(str(tmp_path / 'progress.html')) as f:
+        content = f.read()
+    assert '执行完成: 16/16' in content and 'http-equiv="refresh"' not in content
+    state = json.loads(urlopen(server.url + 'state').read())
+    assert state['finished'] and state['done'] == 16 and not state['running']
+    server.close()
+
+
+class AsyncTests(unittest.IsolatedAsyncioTestCase):
+    __test__ = False
+    events = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.events.append('setUpClass')
+
+    async def asyncSetUp(self):
+        self.addAsyncCleanup(self.cleanup)
+
+    async def cleanup(self):
+        self.events.append('cleanup')
+
+    async def test_wait_1(self):
+        print('wait 1')
+        await asyncio.sleep(0.2)
+        print('done 1')
+
+    async def test_wait_2(self):
+        print('wait 2')
+        await asyncio.sleep(0.2)
+        self.fail('done 2')
+
+    @reportz.timeout(0.1)
+    async def test_hang(self):
+        await asyncio.sleep(5)
+
+    @unittest.skip('skipped')
+    async def test_skip(self):
+        pass
+
+    def test_sync(self):
+        print('sync')
+
+
+def test_asyncio_concurrency():
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(AsyncTests)
+    AsyncTests.events.clear()
+    t0 = time.monotonic()
+    result = Runner().run(suite, concurrency=10)
+    assert time.monotonic() - t0 < 0.5
+    records = {record.name: record for record in result.result.values()}
+    assert records['test_wait_1'].status == 'PASS' and records['test_wait_1'].output == 'wait 1\ndone 1\n'
+    assert records['test_wait_2'].status == 'FAIL' and records['test_wait_2'].output == 'wait 2\n'
+    assert records['test_wait_1'].duration >= timedelta(seconds=0.2)
+    assert records['test_hang'].status == 'TIMEOUT'
+    assert records['test_skip'].status == 'SKIPPED'
+    assert records['test_sync'].status == 'PASS' and records['test_sync'].output == 'sync\n'
+    assert AsyncTests.events == ['setUpClass'] + ['cleanup'] * 4
+
+
+def test_warm_pool(tmp_path):
+    import shutil
+    import socket
+    import subprocess
+    from reportz.pool import run_in_pool
+    if not hasattr(socket, 'send_fds'):
+        return
+    shutil.copytree(testpath, str(tmp_path / 'data'))
+    env = dict(os.environ, PYTHONPATH=basedir)
+    address = str(tmp_path / 'pool.sock')
+    server = subprocess.Popen([sys.executable, '-m', 'reportz', 'serve', 'data', '--address', address],
+                              cwd=str(tmp_path), env=env, stderr=subprocess.PIPE)
+    try:
+        assert b'ready' in server.stderr.readline()
+        cwd = os.getcwd()
+        os.chdir(str(tmp_path))
+        try:
+            code = run_in_pool(['run', 'data', '--workers', '2', '-o', 'report.html', '--no-echo'], address)
+        finally:
+            os.chdir(cwd)
+        assert code == 1  # 示例用例中有失败的用例
+        with open(str(tmp_path / 'report.html')) as f:
+            assert '总数: 16' in f.read()
+    finally:
+        server.kill()
+        server.wait()
+
+
+class BrokenFixtureTests(unittest.TestCase):
+    __test__ = False
+
+    @classmethod
+    def setUpClass(cls):
+        raise RuntimeError('broken fixture')
+
+    def test_a(self):
+        pass
+
+    def test_b(self):
+        pass
+
+    def test_c(self):
+        pass
+
+
+def test_fixture_error_uses_index(monkeypatch):
+    import importlib
+
+    def no_import(*args, **kwargs):
+        raise AssertionError('fixture errors should not re-import modules')
+    monkeypatch.setattr(importlib, 'import_module', no_import)
+    suite = unittest.TestSuite([BrokenFixtureTests('test_a'), BrokenFixtureTests('test_b')])
+    result = Runner().run(suite)
+    assert sorted(record.name for record in result.result.values()) == ['test_a', 'test_b']
+    assert {record.status for record in result.result.values()} == {'setUpClass_ERROR'}
+    assert 'broken fixture' in result.errors[0][1]
+
+
+class AttachmentTests(reportz.AttachMixin, unittest.TestCase):
+    __test__ = False
+    png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+    def tearDown(self):
+        self.attach('teardown.png', self.png)  # 与用例中的截图内容相同
+
+    def test_attach(self):
+        self.attach('page.png', self.png)
+        self.attach('server.log', ('line\n' * 10000).encode())
+
+    def test_fail(self):
+        self.fail('boom')
+
+
+def test_attachments_are_deduplicated(tmp_path):
+    import gzip
+    from reportz import AttachmentStore, Result, attach
+    result = Result()
+    result.attachments = AttachmentStore(str(tmp_path / 'attachments'))
+    Runner().run(unittest.TestLoader().loadTestsFromTestCase(AttachmentTests), result=result)
+    items = result.result[AttachmentTests('test_attach').id()].attachments
+    assert [item['name'] for item in items] == ['page.png', 'server.log', 'teardown.png']
+    assert items[0]['path'] == items[2]['path'] and items[0]['mime'] == 'image/png'
+    assert items[1]['compressed'] and items[1]['path'].endswith('.log.gz')
+    with open(items[1]['path'], 'rb') as f:
+        assert gzip.decompress(f.read()) == ('line\n' * 10000).encode()
+    failed = result.result[AttachmentTests('test_fail').id()]
+    assert failed.status == 'FAIL' and [item['name'] for item in failed.attachments] == ['teardown.png']
+    files = [name for _, _, names in os.walk(str(tmp_path / 'attachments')) for name in names]
+    assert len(files) == 2
+    try:
+        attach('outside.txt', b'')
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'attach() outside a test should fail'
+
+    output = str(tmp_path / 'report.html')
+    HTMLRunner(output=output).run(unittest.TestLoader().loadTestsFromTestCase(AttachmentTests), workers=2)
+    with open(output) as f:
+        content = f.read()
+    assert content.count('<img loading="lazy"') == 3 and 'report_attachments/' in content
+
+
+def test_failure_clusters(tmp_path):
+    (tmp_path / 'cluster_helper.py').write_text('def connect(n):\n    raise ConnectionError("db %s down" % n)\n')
+    (tmp_path / 'test_cluster.py').write_text(
+        'import unittest\nimport cluster_helper\n\n'
+        'class TestDb(unittest.TestCase):\n' +
+        ''.join('    def test_query_%d(self):\n        cluster_helper.connect(%d)\n\n' % (i, i) for i in range(5)) +
+        '    def test_value(self):\n        self.assertEqual(1, 2)\n')
+    suite = unittest.TestLoader().discover(str(tmp_path), pattern='test_cluster.py')
+    output = str(tmp_path / 'report.html')
+    result = HTMLRunner(output=output).run(suite)
+    clusters = result.clusters.summary()
+    assert [cluster['count'] for cluster in clusters] == [5, 1]
+    assert clusters[0]['exception'] == 'ConnectionError: db 0 down'
+    assert clusters[1]['exception'] == 'AssertionError: 1 != 2'
+    records = [result.result['test_cluster.TestDb.test_query_%d' % i] for i in range(5)]
+    assert {record.failure for record in records} == {clusters[0]['id']}
+    with open(output) as f:
+        content = f.read()
+    assert content.count('Traceback (most recent call last)') == 2
+    assert content.count('href="#failure-%s"' % clusters[0]['id']) == 5
+    assert 'ConnectionError: db 3 down' in content
+    assert records[3].exception == 'ConnectionError: db 3 down'
+
+    stream = str(tmp_path / 'stream.html')
+    result = HTMLRunner(output=stream, template='stream', stream=True).run(suite)
+    assert not result.result and [cluster['count'] for cluster in result.clusters.summary()] == [5, 1]
+    assert len(result.clusters.summary()[0]['tests']) == 5
+
+
+class HistoryTests(unittest.TestCase):
+    __test__ = False
+    round = 0
+
+    def test_stable(self):
+        pass
+
+    def test_flaky(self):
+        self.assertTrue(HistoryTests.round % 2)
+
+    def test_slow(self):
+        time.sleep(0.3 if HistoryTests.round == 6 else 0)
+
+
+def test_run_history(tmp_path):
+    from reportz import RunHistory
+    path = str(tmp_path / 'history.db')
+    for run in range(7):
+        HistoryTests.round = run
+        history = RunHistory(path, min_delta=0.2)
+        output = str(tmp_path / 'report.html')
+        HTMLRunner(output=output, history=history).run(unittest.TestLoader().loadTestsFromTestCase(HistoryTests))
+    trend = history.trend()
+    assert [run['total'] for run in trend] == [3] * 7 and [run['fail_num'] for run in trend] == [1, 0] * 3 + [1]
+    assert [item['test_id'] for item in history.flaky()] == [HistoryTests('test_flaky').id()]
+    assert history.flaky()[0]['flips'] == 6 and history.flaky()[0]['statuses'] == 'FPFPFPF'
+    assert [item['test_id'] for item in history.regressions] == [HistoryTests('test_slow').id()]
+    assert len(RunHistory(path).durations) == 3
+    with open(output) as f:
+        content = f.read()
+    assert '不稳定用例' in content and '耗时退化(1)' in content and content.count('<rect') == 21
+
+
+class ClassEvents(object):
+    """记录class_complete和update的监听者"""
+    def __init__(self):
+        self.classes = []
+        self.updates = []
+
+    def class_complete(self, test_class):
+        self.classes.append((test_class['name'].rsplit('.', 1)[-1], test_class['total']))
+
+    def update(self, record):
+        self.updates.append(record.full_path)
+
+
+def test_late_fixture_error_updates_completed_class(tmp_path):
+    (tmp_path / 'test_late.py').write_text(
+        'import unittest\n\n'
+        'def tearDownModule():\n    raise RuntimeError("teardown")\n\n'
+        'class TestA(unittest.TestCase):\n    def test_1(self):\n        pass\n\n    def test_2(self):\n        pass\n')
+    suite = unittest.TestLoader().discover(str(tmp_path), pattern='test_late.py')
+    events = ClassEvents()
+    result = Result()
+    result.keep_records = False
+    result.echo = False
+    result.add_listener(events)
+    Runner().run(suite, result=result)
+    assert result.stats['total'] == 2 and events.classes == [('TestA', 2)]
+    assert sorted(events.updates) == ['test_late.TestA.test_1', 'test_late.TestA.test_2']
+    assert result.stats['pass_num'] == 0 and result.stats['error_num'] == 2
+
+
+def test_process_pool_completes_each_class_once(tmp_path):
+    from reportz import JUnitExporter
+    (tmp_path / 'test_pool_classes.py').write_text('import time\nimport unittest\n\n' + ''.join(
+        'class Test%s(unittest.TestCase):\n' % name + ''.join(
+            '    def test_%d(self):\n        time.sleep(0.01)\n\n' % i for i in range(size))
+        for name, size in (('A', 3), ('B', 3), ('C', 2), ('D', 2))))
+    suite = unittest.TestLoader().discover(str(tmp_path), pattern='test_pool_classes.py')
+    events = ClassEvents()
+    result = Result()
+    result.echo = False
+    result.add_listener(events)
+    result.add_listener(JUnitExporter(str(tmp_path / 'junit.xml')))
+    Runner().run(suite, workers=2, result=result)
+    assert sorted(events.classes) == [('TestA', 3), ('TestB', 3), ('TestC', 2), ('TestD', 2)]
+    with open(str(tmp_path / 'junit.xml')) as f:
+        content = f.read()
+    assert content.count('<testsuite ') == 4 and content.count('<testcase ') == 10
+
+
+class AsyncSlowTests(unittest.IsolatedAsyncioTestCase):
+    __test__ = False
+
+    async def test_1(self):
+        await asyncio.sleep(0.05)
+
+    async def test_2(self):
+        await asyncio.sleep(0.2)
+
+
+class AsyncFastTests(unittest.IsolatedAsyncioTestCase):
+    __test__ = False
+
+    async def test_1(self):
+        await asyncio.sleep(0.1)
+
+    async def test_2(self):
+        await asyncio.sleep(0.15)
+
+
+def test_asyncio_completes_each_class_once():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([loader.loadTestsFromTestCase(AsyncSlowTests), loader.loadTestsFromTestCase(AsyncFastTests)])
+    events = ClassEvents()
+    result = Result()
+    result.echo = False
+    result.add_listener(events)
+    Runner().run(suite, result=result, concurrency=4)
+    assert events.classes == [('AsyncFastTests', 2), ('AsyncSlowTests', 2)]
+
+
+def test_fixture_error_in_reports(tmp_path):
+    (tmp_path / 'test_teardown_module.py').write_text(
+        'import unittest\n\n'
+        'def tearDownModule():\n    raise RuntimeError("teardown exploded")\n\n'
+        'class TestA(unittest.TestCase):\n    def test_1(self):\n        pass\n\n    def test_2(self):\n        pass\n')
+    for kwargs, run_kwargs in (({}, {}), ({'template': 'stream', 'stream': True}, {}), ({'paged': True}, {}),
+                               ({'paged': True}, {'workers': 1}), ({}, {'thread_num': 2})):
+        output = str(tmp_path / 'report.html')
+        suite = unittest.TestLoader().discover(str(tmp_path), pattern='test_teardown_module.py')
+        result = HTMLRunner(output=output, echo=False, **kwargs).run(suite, **run_kwargs)
+        assert not result.wasSuccessful()
+        assert result.stats['pass_num'] == 0 and result.stats['error_num'] == 2
+        with open(output) as f:
+            assert 'teardown exploded' in f.read()
+
+
+def test_load_error(tmp_path):
+    (tmp_path / 'test_load_broken.py').write_text('import unittest\nimport reportz_missing_module\n')
+    (tmp_path / 'test_load_ok.py').write_text(
+        'import unittest\n\nclass TestOk(unittest.TestCase):\n    def test_ok(self):\n        pass\n')
+    for kwargs in ({}, {'thread_num': 2}, {'workers': 2}, {'concurrency': 2}):
+        suite = unittest.TestLoader().discover(str(tmp_path), pattern='test_load_*.py')
+        result = Result()
+        result.echo = False
+        Runner().run(suite, result=result, **kwargs)
+        assert result.stats['pass_num'] == 1 and result.stats['error_num'] == 1
+        [record] = [record for record in result.result.values() if record.status == 'LOAD_ERROR']
+        assert 'reportz_missing_module' in record.exec_info
+
+
+class TimedTests(unittest.TestCase):
+    __test__ = False
+    timeout = 5
+
+    def test_print(self):
+        print('hello')
+
+
+def test_capture_buffer_small_limits(tmp_path):
+    from reportz import CaptureBuffer
+    for limit in (0, 1, 2):
+        capture = CaptureBuffer(limit, str(tmp_path), eager=True)
+        capture.writelines('line %d\n' % i for i in range(3))
+        value = capture.getvalue()
+        capture.close()
+        if not limit:
+            assert 'line 0\nline 1\nline 2\n' == value == capture.getvalue() and capture.path is None
+        else:
+            assert 'characters omitted' in capture.getvalue() and value.endswith('\n' if limit == 2 else '......\n')
+
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TimedTests)
+    result = HTMLRunner(output=str(tmp_path / 'report.html'), output_limit=0, echo=False).run(suite, workers=1)
+    assert 'PASS' == result.result[TimedTests('test_print').id()].status
+    assert 'hello\n' == result.result[TimedTests('test_print').id()].output
+
+
+def test_pytest_html_rows(tmp_path):
+    from reportz import status_class
+
+    class SlowTests(unittest.TestCase):
+        def test_slow(self):
+            time.sleep(0.05)
+
+    output = str(tmp_path / 'report.html')
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(SlowTests)
+    HTMLRunner(output=output, template='pytest_html', echo=False).run(suite)
+    with open(output) as f:
+        content = f.read()
+    [duration] = re.findall(r'<td class="col-duration">([\d.]+)</td>', content)
+    assert float(duration) >= 0.05 and 'test_slow' in content and 'passed results-table-row' in content
+    for status in ('ERROR', 'setUpClass_ERROR', 'tearDownModule_ERROR', 'LOAD_ERROR'):
+        assert 'error' == status_class(status, 'pass', 'fail', 'error', 'skip')
+    assert 'skip' == status_class('SKIPPED', 'pass', 'fail', 'error', 'skip')
+
+
+class PoolProfiledTests(unittest.TestCase):
+    __test__ = False
+
+    @classmethod
+    def setUpClass(cls):
+        time.sleep(0.05)
+
+    def test_spin(self):
+        sum(range(200000))
+
+
+def test_instrumentation_in_process_pool(tmp_path):
+    import pstats
+    from reportz import Instrumentation
+    instrument = Instrumentation(profile='class', pstats_dir=str(tmp_path / 'pstats'))
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(PoolProfiledTests)
+    HTMLRunner(output=str(tmp_path / 'report.html'), instrument=instrument, echo=False).run(suite, workers=1)
+    [(name, path)] = instrument.pstats.items()
+    assert name.endswith('PoolProfiledTests') and 'sum' in str(pstats.Stats(path).stats)
+    kind, name, seconds = instrument.slowest_fixtures()[0]
+    assert 'setUpClass' == kind and name.endswith('PoolProfiledTests') and seconds >= 0.05
+
+
+def test_thread_pool_merges_classes_as_completed():
+    class SlowThreadTests(unittest.TestCase):
+        def test_1(self):
+            time.sleep(0.3)
+
+        def test_2(self):
+            time.sleep(0.3)
+
+    class FastThreadTests(unittest.TestCase):
+        def test_1(self):
+            pass
+
+    loader = unittest.defaultTestLoader
+    suite = unittest.TestSuite([loader.loadTestsFromTestCase(SlowThreadTests),
+                                loader.loadTestsFromTestCase(FastThreadTests)])
+    events = ClassEvents()
+    result = Result()
+    result.echo = False
+    result.add_listener(events)
+    Runner().run(suite, thread_num=2, result=result)
+    assert [('FastThreadTests', 1), ('SlowThreadTests', 2)] == events.classes
+
+
+def test_result_lists_hold_ids():
+    for kwargs in ({}, {'thread_num': 2}, {'workers': 2}, {'concurrency': 2}):
+        result = Result()
+        result.echo = False
+        Runner().run(unittest.defaultTestLoader.discover(testpath), result=result, **kwargs)
+        assert (12, 2, 2, 5) == (len(result.errors), len(result.failures), len(result.skipped), len(result.success))
+        for test_id, exec_info in result.errors + result.failures + result.skipped:
+            assert isinstance(test_id, str) and isinstance(exec_info, str)
+        assert all(isinstance(test_id, str) for test_id in result.success)
+
+
 if __name__ == "__main__":
     test_with_default_template()
\ No newline at end of file